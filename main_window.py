@@ -1,10 +1,9 @@
 import sys
-import subprocess
-import traceback # For detailed exception logging
+# subprocess, tempfile, shutil, traceback and concurrent.futures are imported inside the functions that use them to keep startup fast
 import re # For parsing winget output
-import tempfile # Added for temporary directory creation
 import os # Added for path operations, if needed later
-import shutil # Added for directory cleanup
+import stat # For telling files from directories with a single os.stat call
+from collections import OrderedDict, namedtuple # For the bounded search-results cache and parsed app rows
 from PySide6.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -19,10 +18,62 @@ from PySide6.QtWidgets import (
     QTextEdit,
     QFileDialog,
     QGroupBox,
+    QCheckBox,
+    QProgressBar,
     QAbstractItemView # Added for table view options
 )
 from PySide6.QtGui import QStandardItemModel, QStandardItem, QIcon
-from PySide6.QtCore import Qt, QSettings
+from PySide6.QtCore import Qt, QSettings, QObject, QThread, QTimer, QSortFilterProxyModel, Signal, Slot
+
+# Precompiled pattern used to find the header row in winget output
+_HEADER_RE = re.compile(r"Name\s+Id\s+Version\s+(?:Match\s+)?Source")
+# Splits a path into digit and non-digit runs so version-numbered folders sort numerically
+_DIGIT_RUN_RE = re.compile(r'(\d+)')
+# Characters kept when app names are used as filenames; everything else is dropped
+_VALID_FN_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-")
+
+# File extensions recognised as downloaded installers
+_INSTALLER_EXTS = frozenset({'.exe', '.msi', '.msix', '.msixbundle', '.appx', '.appxbundle', '.zip'})
+
+# One parsed winget search result, in results-table column order
+WingetApp = namedtuple("WingetApp", ["name", "app_id", "version", "source"])
+
+# Maximum number of distinct search terms whose parsed results are kept in memory
+_SEARCH_CACHE_SIZE = 32
+# Delay after the last keystroke before a typed search term is sent to winget
+_SEARCH_DEBOUNCE_MS = 300
+# Queued log lines are written to the log window at most this often
+_LOG_FLUSH_MS = 50
+# PackageWorker stages: download, script generation, IntuneWinAppUtil.exe
+_PACKAGE_STEP_COUNT = 3
+# Seconds to wait before each retry of a temp dir delete that failed
+_CLEANUP_RETRY_DELAYS = (0.1, 0.5, 2.0)
+# Name prefix of each session's temp root in the OS temp directory
+_TEMP_ROOT_PREFIX = "winget2intune_"
+# File a running session keeps locked inside its temp root, so other instances never treat the root as stale
+_SESSION_LOCK_NAME = "session.lock"
+# Temp roots left behind by earlier sessions (e.g. after a crash) are removed once this old
+_STALE_TEMP_ROOT_DAYS = 7
+# Look for stale temp roots this long after startup, once the window is up
+_STALE_TEMP_REAP_DELAY_MS = 5000
+
+# Set WINGET2INTUNE_DEBUG=1 to include full Python tracebacks in the log when an operation fails, even without
+# the Verbose log checkbox ticked
+_DEBUG = os.environ.get("WINGET2INTUNE_DEBUG", "") not in ("", "0")
+
+# Fixed parts of the external commands; the per-app arguments are appended at call time
+_WINGET_DL = (
+    'winget', 'download',
+    '--exact', # Ensure only the requested version is targeted
+    '--accept-package-agreements',
+    '--accept-source-agreements',
+    # Consider adding --scope machine if applicable and supported by download
+)
+_INTUNEWIN_FLAGS = ('-q',) # Quiet mode, suppress UI of the tool
+
+# Generated scripts only live until IntuneWinAppUtil has packed them. On Windows, O_SHORT_LIVED marks them
+# FILE_ATTRIBUTE_TEMPORARY so the cache manager can keep them in memory instead of flushing them to disk.
+_SCRIPT_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0) | getattr(os, "O_SHORT_LIVED", 0)
 
 # Helper function to get correct path for bundled resources
 def resource_path(relative_path):
@@ -34,443 +85,1013 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
-class MainWindow(QMainWindow):
-    def __init__(self):
-        super().__init__()
+def _format_command(command):
+    """Formats an argument list as the command line Popen runs on Windows, quoting arguments that contain spaces."""
+    import subprocess
+    return subprocess.list2cmdline(command)
+
+def _run_merged_output(command, on_start=None):
+    """Runs command with stderr merged into stdout and returns (returncode, non-empty output lines).
+
+    on_start, if given, is called with the Popen object once the process is running (e.g. to be able to
+    terminate it). Touches no Qt objects, so it is safe to run on a worker thread.
+    """
+    import subprocess
+    # Read the combined output line by line instead of buffering it all; one pipe cannot deadlock
+    with subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        bufsize=1
+    ) as process:
+        if on_start is not None:
+            on_start(process)
+        output_lines = [line for line in map(str.rstrip, process.stdout) if line]
+        process.wait()
+    return process.returncode, output_lines
+
+# Characters that are special inside a double-quoted PowerShell string, each escaped with a backtick.
+# PowerShell also treats typographic double quotes as string delimiters.
+_PS_ESCAPES = str.maketrans({c: '`' + c for c in '`"$\u201c\u201d\u201e'})
+
+def _ps_escape(value):
+    """Escapes value for embedding in a double-quoted PowerShell string."""
+    return value.translate(_PS_ESCAPES)
+
+# Characters cmd.exe may interpret even inside a quoted argument; paths containing them skip the rmdir fast path
+_CMD_UNSAFE_CHARS = frozenset('%"^!&|<>')
+
+def _fast_rmtree(path):
+    """Deletes the directory tree at path with the platform's native recursive delete, falling back to _rmtree_scandir.
+
+    One `rmdir /s /q` (Windows) or `rm -rf` process removes large trees far faster than Python's per-file
+    stat/unlink loop. Raises OSError if the tree could not be removed.
+    """
+    import subprocess
+    if os.name == 'nt':
+        # A string command line, so the path is quoted exactly once for cmd.exe
+        command = None if _CMD_UNSAFE_CHARS.intersection(path) else f'cmd /d /c rmdir /s /q "{path}"'
+    else:
+        command = ['rm', '-rf', '--', path]
+    if command is not None:
+        try:
+            subprocess.run(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=False,
+                creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0) # No console window flash from the GUI
+            )
+        except OSError:
+            pass # Shell or rm unavailable; _rmtree_scandir below does the work
+    if os.path.lexists(path): # Fast path skipped or left something behind (e.g. a file in use)
+        _rmtree_scandir(path)
+
+def _is_within_dir(path, root):
+    """True if path resolves (following symlinks) to a location strictly inside the directory root."""
+    root = os.path.normcase(os.path.realpath(root))
+    target = os.path.normcase(os.path.realpath(path))
+    return target.startswith(root.rstrip(os.sep) + os.sep)
+
+def _lock_file_nonblocking(f):
+    """Takes an exclusive lock on the open file f without waiting. Returns False if another holder has it.
+
+    The lock is released when f is closed or the process exits, including after a crash.
+    """
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+def _temp_root_in_use(root):
+    """True if a running session holds the lock file inside the temp root at root."""
+    try:
+        f = open(os.path.join(root, _SESSION_LOCK_NAME), 'rb')
+    except FileNotFoundError:
+        return False # Root from a version without lock files, or from a session that died while creating it
+    except OSError:
+        return True # e.g. a sharing violation on Windows; err on the side of keeping the root
+    with f:
+        return not _lock_file_nonblocking(f)
+
+def _rmtree_scandir(path):
+    """Deletes the directory tree at path in Python, using the file types os.scandir reports instead of a stat per entry.
+
+    Symlinks are unlinked, never followed. Raises OSError on the first entry that cannot be removed.
+    """
+    dirs_to_remove = []
+    stack = [path]
+    while stack:
+        dir_path = stack.pop()
+        dirs_to_remove.append(dir_path)
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    os.unlink(entry.path)
+    # Parents were listed before their children, so removing in reverse empties each directory first
+    for dir_path in reversed(dirs_to_remove):
+        os.rmdir(dir_path)
+
+def _delete_on_reboot(path):
+    """Schedules what is left of the tree at path for deletion at the next Windows restart (MoveFileEx).
+
+    Returns True if every file and directory was scheduled. Scheduling needs administrator rights, so this
+    commonly returns False for standard users; the directory then stays until something else removes it.
+    """
+    import ctypes
+    move_file_ex = ctypes.windll.kernel32.MoveFileExW
+    move_file_ex.argtypes = (ctypes.c_wchar_p, ctypes.c_wchar_p, ctypes.c_uint32)
+    MOVEFILE_DELAY_UNTIL_REBOOT = 0x4
+    scheduled = True
+    # Bottom-up, so each directory is queued after its contents and is empty by the time Windows removes it
+    for dir_path, _, file_names in os.walk(path, topdown=False):
+        for name in file_names:
+            scheduled = bool(move_file_ex(os.path.join(dir_path, name), None, MOVEFILE_DELAY_UNTIL_REBOOT)) and scheduled
+        scheduled = bool(move_file_ex(dir_path, None, MOVEFILE_DELAY_UNTIL_REBOOT)) and scheduled
+    return scheduled
+
+def _link_or_copy(src, dst):
+    """Hard-links src to dst, falling back to a copy when linking is not possible (e.g. across volumes)."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        import shutil
+        shutil.copy2(src, dst)
 
-        self.setWindowTitle("Winget2Intunewin GUI Packer")
-        self.setGeometry(100, 100, 900, 700) # Adjusted size for better layout
+def _stat_kind(path, cache):
+    """Returns 'file', 'dir' or None for path from a single os.stat call, memoized in the cache dict."""
+    try:
+        return cache[path]
+    except KeyError:
+        pass
+    try:
+        mode = os.stat(path).st_mode
+    except (OSError, ValueError):
+        kind = None
+    else:
+        kind = 'file' if stat.S_ISREG(mode) else 'dir' if stat.S_ISDIR(mode) else None
+    cache[path] = kind
+    return kind
+
+# IntuneWinAppUtil.exe paths confirmed to exist this session. Only hits are kept, so a tool put in place
+# after a failed check is found on the next one without reconfiguring.
+_intunewin_util_found = set()
+
+def _locate_intunewin_util(configured_path):
+    """Returns configured_path if it is an existing file, else None.
+
+    Hits are remembered so back-to-back packaging runs skip the probe; discard the path from
+    _intunewin_util_found when the file at it may have changed (e.g. it could not be started).
+    """
+    if configured_path in _intunewin_util_found:
+        return configured_path
+    if configured_path and os.path.isfile(configured_path):
+        _intunewin_util_found.add(configured_path)
+        return configured_path
+    return None
+
+# PowerShell script templates, rendered with str.format_map over the context from MainWindow._script_context.
+# {app_id_ps}, {app_name_ps}, {app_version_ps} and {winget_path_ps} are placeholders, already escaped with _ps_escape;
+# literal PowerShell braces are doubled ({{ }}).
+_INSTALL_PS1_TEMPLATE = r"""# install.ps1 - Generated by Winget2Intunewin GUI Packer
+# The defaults are the app this package was built for; pass -AppId/-AppName/-AppVersion to override them.
+param(
+    [string]$AppId = "{app_id_ps}",
+    [string]$AppName = "{app_name_ps}", # Used for logging
+    [string]$AppVersion = "{app_version_ps}" # Used for specific version install
+)
 
-        # Set Application Window Icon
-        try:
-            icon_path = resource_path("assets/logo.png")
-            if os.path.exists(icon_path):
-                self.setWindowIcon(QIcon(icon_path))
-            else:
-                # This print might not be visible in a bundled app without console
-                print(f"Warning: Window Icon file not found at {icon_path}. Using default icon.")
-        except Exception as e:
-            print(f"Error setting window icon: {e}")
+$ErrorActionPreference = 'Stop'
+$ProgressPreference = 'SilentlyContinue'
 
-        self.selected_app_data = None # To store data of the selected app
-        self.current_temp_dir = None # To store the path of the current temporary directory
-        self.downloaded_installer_path = None # To store the path to the downloaded installer
-        self.install_script_path = None # To store the path to the generated install.ps1
-        self.uninstall_script_path = None # To store the path to the generated uninstall.ps1
-        self.detection_script_path = None # To store the path to the generated detection.ps1
-        self.intunewin_util_path = None # To store path to IntuneWinAppUtil.exe
+Write-Host "Starting installation process for $AppName (ID: $AppId, Version: $AppVersion)..."
 
-        # Main widget and layout
-        central_widget = QWidget()
-        self.setCentralWidget(central_widget)
-        main_layout = QVBoxLayout(central_widget)
+$WingetPath = "{winget_path_ps}" # Resolved when the package was built; may not exist on this device
+# Fall back to searching common locations if it does not
+if (-not ($WingetPath -and (Test-Path $WingetPath))) {{
+    if (Test-Path "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe") {{
+        $WingetPath = Get-Item "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe" | Sort-Object Name -Descending | Select-Object -First 1 -ExpandProperty FullName
+    }} elseif (Test-Path "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe") {{
+        $WingetPath = "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe"
+    }} else {{
+        Write-Error "Winget executable not found in common paths. Please ensure Winget is installed and accessible."
+        exit 1
+    }}
+}}
 
-        # --- Search & Selection Area ---
-        search_group = QGroupBox("Search & Selection")
-        search_layout = QVBoxLayout()
+Write-Host "Using Winget executable at: $WingetPath"
 
-        # Application Search Input
-        search_input_layout = QHBoxLayout()
-        search_input_layout.addWidget(QLabel("Search for Application:"))
-        self.search_input = QLineEdit()
-        search_input_layout.addWidget(self.search_input)
-        self.search_button = QPushButton("Search")
-        search_input_layout.addWidget(self.search_button)
-        search_layout.addLayout(search_input_layout)
+try {{
+    Write-Host "Executing: `"$WingetPath`" install --id `"$AppId`" --version `"$AppVersion`" --exact --scope machine --accept-package-agreements --accept-source-agreements --disable-interactivity"
+    # Using Start-Process to better handle execution and capture exit codes if needed, though direct call is also fine.
+    # Add --disable-interactivity for robust silent execution
+    & $WingetPath install --id "$AppId" --version "$AppVersion" --exact --scope machine --accept-package-agreements --accept-source-agreements --disable-interactivity
+    
+    if ($LASTEXITCODE -ne 0) {{
+        Write-Error "Winget install command failed for $AppId with exit code $LASTEXITCODE."
+        exit $LASTEXITCODE
+    }}
+    Write-Host "Winget install command for $AppId (Version: $AppVersion) completed successfully."
+    
+    # Optional: Add further verification steps here if the application creates a specific registry key or file.
 
-        # Search Results Display
-        self.search_results_table = QTableView()
-        self.table_model = QStandardItemModel()
-        self.table_model.setHorizontalHeaderLabels(["Name", "ID", "Version", "Source"])
-        self.search_results_table.setModel(self.table_model)
-        self.search_results_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
-        self.search_results_table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
-        self.search_results_table.setEditTriggers(QAbstractItemView.EditTriggers.NoEditTriggers)
-        self.search_results_table.horizontalHeader().setStretchLastSection(True)
-        # self.search_results_table.resizeColumnsToContents() # Call after populating
-        search_layout.addWidget(self.search_results_table)
-        search_group.setLayout(search_layout)
-        main_layout.addWidget(search_group)
-        
-        # --- Packaging Configuration Area ---
-        packaging_group = QGroupBox("Packaging Configuration")
-        packaging_layout = QVBoxLayout()
+}} 
+catch {{
+    Write-Error "An error occurred during the installation of $AppName (ID: $AppId, Version: $AppVersion)."
+    Write-Error $_.Exception.Message
+    # Attempt to get more details if it's a Winget error specifically
+    if ($_.Exception.InnerException) {{
+        Write-Error "Inner Exception: $($_.Exception.InnerException.Message)"
+    }}
+    exit 1 # General error code
+}}
 
-        # Selected Application Display (simplified for now)
-        self.selected_app_label = QLabel("Selected App: None")
-        packaging_layout.addWidget(self.selected_app_label)
+Write-Host "Installation script for $AppName (ID: $AppId, Version: $AppVersion) finished."
+exit 0
+"""
 
-        # Output Folder Selection
-        output_folder_layout = QHBoxLayout()
-        output_folder_layout.addWidget(QLabel("Output Folder for .intunewin:"))
-        self.output_folder_input = QLineEdit()
-        self.output_folder_input.setReadOnly(True) # User selects via browse
-        output_folder_layout.addWidget(self.output_folder_input)
-        self.browse_button = QPushButton("Browse...")
-        output_folder_layout.addWidget(self.browse_button)
-        packaging_layout.addLayout(output_folder_layout)
+_UNINSTALL_PS1_TEMPLATE = r"""# uninstall.ps1 - Generated by Winget2Intunewin GUI Packer
+# The defaults are the app this package was built for; pass -AppId/-AppName to override them.
+param(
+    [string]$AppId = "{app_id_ps}",
+    [string]$AppName = "{app_name_ps}" # Used for logging
+)
 
-        # IntuneWinAppUtil.exe Path Selection
-        intunewin_util_layout = QHBoxLayout()
-        intunewin_util_layout.addWidget(QLabel("Path to IntuneWinAppUtil.exe:"))
-        self.intunewin_util_input = QLineEdit()
-        self.intunewin_util_input.setReadOnly(True)
-        intunewin_util_layout.addWidget(self.intunewin_util_input)
-        self.browse_intunewin_util_button = QPushButton("Browse...")
-        intunewin_util_layout.addWidget(self.browse_intunewin_util_button)
-        packaging_layout.addLayout(intunewin_util_layout)
+$ErrorActionPreference = 'Stop'
+$ProgressPreference = 'SilentlyContinue'
 
-        packaging_group.setLayout(packaging_layout)
-        main_layout.addWidget(packaging_group)
+Write-Host "Starting uninstallation process for $AppName (ID: $AppId)..."
 
-        # --- Action & Status Area ---
-        action_status_group = QGroupBox("Action & Status")
-        action_status_layout = QVBoxLayout()
+$WingetPath = "{winget_path_ps}" # Resolved when the package was built; may not exist on this device
+# Fall back to searching common locations if it does not
+if (-not ($WingetPath -and (Test-Path $WingetPath))) {{
+    if (Test-Path "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe") {{
+        $WingetPath = Get-Item "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe" | Sort-Object Name -Descending | Select-Object -First 1 -ExpandProperty FullName
+    }} elseif (Test-Path "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe") {{
+        $WingetPath = "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe"
+    }} else {{
+        Write-Error "Winget executable not found in common paths. Please ensure Winget is installed and accessible."
+        # For uninstall, if winget is not found, we might not want to fail the whole script if the app isn't there anyway.
+        # However, for an explicit uninstall command, it is an error if winget itself is missing.
+        exit 1 
+    }}
+}}
 
-        # Package Button
-        self.package_button = QPushButton("Create .intunewin Package")
-        action_status_layout.addWidget(self.package_button, alignment=Qt.AlignmentFlag.AlignCenter) # Center the button
+Write-Host "Using Winget executable at: $WingetPath"
 
-        # Log Window (Optional detailed log)
-        self.log_window = QTextEdit()
-        self.log_window.setReadOnly(True)
-        action_status_layout.addWidget(self.log_window)
-        action_status_group.setLayout(action_status_layout)
-        main_layout.addWidget(action_status_group)
+# Check if the application is installed before attempting to uninstall
+Write-Host "Checking if $AppName (ID: $AppId) is installed..."
+$InstalledApp = & $WingetPath list --id "$AppId" --accept-source-agreements
+
+if ($InstalledApp -match $AppId) {{
+    Write-Host "$AppName (ID: $AppId) is installed. Proceeding with uninstall."
+    try {{
+        Write-Host "Executing: `"$WingetPath`" uninstall --id `"$AppId`" --accept-package-agreements --accept-source-agreements --disable-interactivity"
+        & $WingetPath uninstall --id "$AppId" --accept-package-agreements --accept-source-agreements --disable-interactivity
         
-        # Status Bar
-        self.setStatusBar(QStatusBar(self))
-        self.statusBar().showMessage("Ready")
+        if ($LASTEXITCODE -ne 0) {{
+            Write-Error "Winget uninstall command failed for $AppId with exit code $LASTEXITCODE."
+            exit $LASTEXITCODE
+        }}
+        Write-Host "Winget uninstall command for $AppId completed successfully."
+    }}
+    catch {{
+        Write-Error "An error occurred during the uninstallation of $AppName (ID: $AppId)."
+        Write-Error $_.Exception.Message
+        if ($_.Exception.InnerException) {{
+            Write-Error "Inner Exception: $($_.Exception.InnerException.Message)"
+        }}
+        exit 1 # General error code
+    }}
+}} else {{
+    Write-Host "$AppName (ID: $AppId) is not found or not installed via Winget. Uninstall script will consider this a success (nothing to uninstall)."
+    # In Intune, an uninstall script exiting with 0 when the app is not found is often desired.
+    exit 0 
+}}
 
-        # Connect signals to slots
-        self.browse_button.clicked.connect(self.open_output_folder_dialog)
-        self.search_button.clicked.connect(self.handle_search_button_clicked)
-        self.search_results_table.selectionModel().selectionChanged.connect(self.handle_table_selection_changed)
-        self.browse_intunewin_util_button.clicked.connect(self._browse_for_intunewin_util) # Connect new button
-        self.package_button.clicked.connect(self.handle_package_button_clicked) # Connect package button
+Write-Host "Uninstallation script for $AppName (ID: $AppId) finished."
+exit 0
+"""
 
-        self._load_settings() # Load settings on startup
+_DETECTION_PS1_TEMPLATE = r"""# detection.ps1 - Generated by Winget2Intunewin GUI Packer
+# The defaults are the app this package was built for; pass -AppId/-AppName/-AppVersion to override them.
+param(
+    [string]$AppId = "{app_id_ps}",
+    [string]$AppName = "{app_name_ps}",
+    [string]$AppVersion = "{app_version_ps}"
+)
 
-        # TODO: Connect other signals to slots (e.g., package_button)
-        # TODO: Implement dark mode theme (initial version applied, can be refined)
+$ErrorActionPreference = 'Stop'
+$ProgressPreference = 'SilentlyContinue'
 
-    def open_output_folder_dialog(self):
-        folder_path = QFileDialog.getExistingDirectory(
-            self,
-            "Select Output Folder",
-            self.output_folder_input.text() # Start at current path if any
-        )
-        if folder_path:
-            self.output_folder_input.setText(folder_path)
-            self.statusBar().showMessage(f"Output folder set to: {folder_path}")
+Write-Host "Starting detection for $AppName (ID: $AppId, Version: $AppVersion)..."
+
+$WingetPath = "{winget_path_ps}" # Resolved when the package was built; may not exist on this device
+# Fall back to searching common locations if it does not
+if (-not ($WingetPath -and (Test-Path $WingetPath))) {{
+    if (Test-Path "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe") {{
+        $WingetPath = Get-Item "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe" | Sort-Object Name -Descending | Select-Object -First 1 -ExpandProperty FullName
+    }} elseif (Test-Path "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe") {{
+        $WingetPath = "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe"
+    }} else {{
+        Write-Host "Winget executable not found. Cannot perform detection."
+        exit 1
+    }}
+}}
+
+Write-Host "Using Winget executable at: $WingetPath"
+
+$ExitCode = 1 # Default to not detected
+
+try {{
+    Write-Host "Executing: `"$WingetPath`" list --id `"$AppId`" --version `"$AppVersion`" --exact --accept-source-agreements"
+    # Capture stdout and stderr directly; 'Continue' keeps merged stderr lines from becoming terminating errors
+    $ErrorActionPreference = 'Continue'
+    $DetectionOutput = & $WingetPath list --id "$AppId" --version "$AppVersion" --exact --accept-source-agreements 2>&1 | ForEach-Object {{ "$_" }}
+    $CmdExitCode = $LASTEXITCODE
+    $ErrorActionPreference = 'Stop'
+
+    if ($CmdExitCode -eq 0) {{
+        # One pattern, built once, requiring both the ID and the version anywhere on a line
+        $DetectPattern = '(?=.*' + [regex]::Escape($AppId) + ')(?=.*' + [regex]::Escape($AppVersion) + ')'
+        $Match = $DetectionOutput | Select-String -Pattern $DetectPattern | Select-Object -First 1
+        if ($Match) {{
+            Write-Host "Detected: $AppName (ID: $AppId Version: $AppVersion) - Matched Line: $($Match.Line)"
+            $ExitCode = 0 # Detected
+        }} else {{
+             Write-Host "Application $AppId with version $AppVersion not found in winget list output (command exit code 0)."
+        }}
+    }} else {{
+        Write-Host "Winget list command failed with exit code $CmdExitCode."
+        if ($DetectionOutput) {{
+            Write-Host "Winget list output: $DetectionOutput"
+        }}
+    }}
+}} catch {{
+    Write-Host "An error occurred during the detection process for $AppName (ID: $AppId, Version: $AppVersion). Error: $($_.Exception.Message)"
+    if ($_.Exception.InnerException) {{
+        Write-Host "Inner Exception: $($_.Exception.InnerException.Message)"
+    }}
+    # ExitCode remains 1 (default)
+}}
 
-    def parse_winget_search_output(self, output_text):
+if ($ExitCode -eq 0) {{
+    Write-Host "Final Detection Status: Application Found - $AppName (ID: $AppId, Version: $AppVersion). This output is used by Intune."
+}} else {{
+    Write-Host "Final Detection Status: Application Not Found - $AppName (ID: $AppId, Version: $AppVersion)."
+}}
+
+exit $ExitCode
+"""
+
+# Modern Dark Theme with Blue/Purple Gradients, applied by MainWindow.apply_dark_mode
+_DARK_QSS = """
+QWidget {
+    background-color: #1e1e2f; /* Dark blue-ish grey */
+    color: #e0e0e0; /* Light grey text */
+    font-size: 10pt;
+    font-family: "Segoe UI", Arial, sans-serif;
+}
+QMainWindow {
+    background-color: #1e1e2f;
+}
+QGroupBox {
+    background-color: transparent; /* Make GroupBox background transparent */
+    border: 1px solid #4a00e0; /* Purple border */
+    border-radius: 8px;
+    margin-top: 1.5ex; /* Increased top margin for title space */ 
+    font-weight: bold;
+    padding-top: 1.5ex; /* Add padding on top of groupbox content area to push it down */
+}
+QGroupBox::title {
+    subcontrol-origin: margin; /* Position relative to the margin */
+    subcontrol-position: top left; 
+    padding: 5px 15px; /* Increased padding for title text */
+    background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #8A2BE2, stop:1 #4A00E0); /* BlueViolet to darker Purple gradient */
+    color: #ffffff;
+    border-radius: 6px; /* Slightly less than GroupBox for a mild inset visual, or match GroupBox's 8px */
+    font-weight: bold;
+    /* Additional offset if needed, negative values pull it up/left */
+    left: 10px; /* Nudge title to the right a bit from the very edge */
+}
+QLineEdit, QTextEdit, QTableView {
+    background-color: #252538;
+    color: #e0e0e0;
+    border: 1px solid #8A2BE2; /* Lighter Purple border for inputs */
+    border-radius: 5px;
+    padding: 6px;
+}
+QTableView {
+    gridline-color: #4169E1; /* Royal Blue grid lines */
+}
+QHeaderView::section { /* For QTableView header */
+    background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #4169E1, stop:1 #3A5FCD); /* RoyalBlue to slightly darker blue */
+    color: #ffffff;
+    padding: 5px;
+    border: 1px solid #3A5FCD;
+    font-weight: bold;
+}
+QPushButton {
+    background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #8A2BE2, stop:1 #4169E1); /* BlueViolet to RoyalBlue gradient */
+    color: #ffffff;
+    border: none; /* Remove default border */
+    border-radius: 5px;
+    padding: 8px 15px;
+    font-weight: bold;
+    min-height: 22px;
+}
+QPushButton:hover {
+    background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #9B30FF, stop:1 #5179FF); /* Lighter gradient on hover */
+}
+QPushButton:pressed {
+    background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #4A00E0, stop:1 #2A4FAD); /* Darker gradient on press */
+}
+QLabel {
+    color: #f0f0f0; /* Brighter white for labels */
+    font-weight: bold; /* Make labels bold */
+}
+QStatusBar {
+    color: #cccccc;
+}
+QStatusBar::item {
+    border: none; /* Remove borders from status bar items */
+}
+QScrollBar:horizontal {
+    border: none;
+    background: #252538;
+    height: 10px;
+    margin: 0px 20px 0 20px;
+    border-radius: 5px;
+}
+QScrollBar::handle:horizontal {
+    background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #8A2BE2, stop:1 #4169E1);
+    min-width: 20px;
+    border-radius: 5px;
+}
+QScrollBar::add-line:horizontal, QScrollBar::sub-line:horizontal {
+    border: none;
+    background: none;
+    width: 20px;
+}
+QScrollBar::add-page:horizontal, QScrollBar::sub-page:horizontal {
+    background: none;
+}
+QScrollBar:vertical {
+    border: none;
+    background: #252538;
+    width: 10px;
+    margin: 20px 0 20px 0;
+    border-radius: 5px;
+}
+QScrollBar::handle:vertical {
+    background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 #8A2BE2, stop:1 #4169E1);
+    min-height: 20px;
+    border-radius: 5px;
+}
+QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical {
+    border: none;
+    background: none;
+    height: 20px;
+}
+QScrollBar::add-page:vertical, QScrollBar::sub-page:vertical {
+    background: none;
+}
+/* Style for the QLineEdit used in the QFileDialog to make it match the theme */
+QFileDialog QLineEdit {
+     background-color: #252538;
+     color: #e0e0e0;
+     border: 1px solid #8A2BE2;
+     border-radius: 5px;
+     padding: 6px;
+}
+"""
+
+class TempDirCleanupWorker(QObject):
+    """Deletes a packaging temp directory off the GUI thread."""
+    log = Signal(str)
+    finished = Signal(str, bool)
+
+    def __init__(self, temp_dir_path, log_verbose=False):
+        super().__init__()
+        self.temp_dir_path = temp_dir_path
+        self.log_tracebacks = _DEBUG or log_verbose
+
+    @Slot()
+    def run(self):
+        import time
+        try:
+            # Files of a just-finished package are often still briefly locked (e.g. by antivirus), so back off and retry
+            for delay in _CLEANUP_RETRY_DELAYS:
+                try:
+                    _fast_rmtree(self.temp_dir_path)
+                    break
+                except OSError:
+                    time.sleep(delay)
+            else:
+                _fast_rmtree(self.temp_dir_path) # Last attempt; its error is reported below
+            success = True
+        except Exception as e:
+            message = f"ERROR: Failed to cleanup temporary directory '{self.temp_dir_path}': {type(e).__name__}: {e}"
+            if self.log_tracebacks: # Formatting the stack is only worth it when someone asked for the detail
+                import traceback
+                message += "\n" + traceback.format_exc()
+            if os.name == 'nt' and _delete_on_reboot(self.temp_dir_path):
+                message += "\nINFO: The remaining files will be deleted when Windows next restarts."
+            self.log.emit(message)
+            success = False
+        self.finished.emit(self.temp_dir_path, success)
+
+class StaleTempRootReaper(QObject):
+    """Removes temp roots that earlier sessions left in the OS temp directory, off the GUI thread."""
+    log = Signal(str)
+    finished = Signal()
+
+    @Slot()
+    def run(self):
+        import tempfile
+        import time
+        cutoff = time.time() - _STALE_TEMP_ROOT_DAYS * 24 * 60 * 60
+        removed = 0
+        try:
+            # DirEntry carries the name and, on Windows, the stat data from the listing itself
+            with os.scandir(tempfile.gettempdir()) as entries:
+                for entry in entries:
+                    if QThread.currentThread().isInterruptionRequested(): # The window is closing
+                        break
+                    if not entry.name.startswith(_TEMP_ROOT_PREFIX) or not entry.is_dir(follow_symlinks=False):
+                        continue
+                    try:
+                        if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                            continue
+                        # The root's mtime only changes when a direct child comes or goes, so an old mtime
+                        # does not mean the session is over; a live session holds its lock file
+                        if _temp_root_in_use(entry.path):
+                            continue
+                        _fast_rmtree(entry.path)
+                        removed += 1
+                    except OSError as e:
+                        self.log.emit(f"WARNING: Could not remove stale temporary directory '{entry.path}': {type(e).__name__}: {e}")
+        except OSError as e:
+            self.log.emit(f"WARNING: Could not scan the temporary directory for stale packaging files: {type(e).__name__}: {e}")
+        if removed:
+            self.log.emit(f"INFO: Removed stale temporary directories left by earlier sessions (older than {_STALE_TEMP_ROOT_DAYS} days): {removed}")
+        self.finished.emit()
+
+class _ProcessWorker(QObject):
+    """Base for workers that run child processes; cancel() terminates them so a closing window need not wait.
+
+    Subclasses define a status signal and emit the lines collected in _log_lines through their log signal.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._log_lines = [] # Collected by _log and emitted by the subclass as a single log message
+        import threading
+        self._process_lock = threading.Lock() # Guards _processes and _cancelled; cancel() runs on the GUI thread
+        self._processes = [] # Child processes started by this worker
+        self._cancelled = False
+
+    def cancel(self):
+        """Stops the run as soon as possible by terminating its child processes. Safe to call from any thread."""
+        with self._process_lock:
+            self._cancelled = True
+            processes = list(self._processes)
+        for process in processes:
+            self._terminate(process)
+
+    def _track_process(self, process):
+        """Registers a started child process so cancel() can terminate it; terminates it at once if already cancelled."""
+        with self._process_lock:
+            self._processes.append(process)
+            cancelled = self._cancelled
+        if cancelled:
+            self._terminate(process)
+
+    @staticmethod
+    def _terminate(process):
+        try:
+            process.terminate() # No-op for a process that has already exited
+        except OSError:
+            pass
+
+    def _log(self, message):
+        self._log_lines.append(message)
+
+    def _report(self, level, message):
+        """Logs message at level ("INFO", "ERROR", ...); errors are also shown in the status bar."""
+        self._log(f"{level}: {message}")
+        if level in ("ERROR", "CRITICAL ERROR"):
+            self.status.emit(message)
+
+class WingetSearchWorker(_ProcessWorker):
+    """Runs `winget search` and parses its output off the GUI thread."""
+    log = Signal(str)
+    status = Signal(str)
+    finished = Signal(list)
+
+    def __init__(self, search_term, log_verbose=False):
+        super().__init__()
+        self.search_term = search_term
+        self.log_tracebacks = _DEBUG or log_verbose
+
+    def parse_winget_search_output(self, output):
+        """Parses winget search output, given as a string or an iterable of lines (e.g. a live stdout pipe)."""
         apps = []
-        lines = output_text.strip().split('\n')
+        # Local aliases avoid repeated attribute lookups in the per-row loop
+        apps_append = apps.append
+        log = self._log
+        lines = iter(output.splitlines() if isinstance(output, str) else output)
         
-        header_index = -1
-        for i, line in enumerate(lines):
-            if re.search(r"Name\s+Id\s+Version\s+(?:Match\s+)?Source", line):
-                header_index = i
+        header_line = None
+        for line in lines:
+            # Cheap substring check first; only candidate lines go through the regex
+            if "Name" not in line or "Id" not in line:
+                continue
+            header_match = _HEADER_RE.search(line)
+            if header_match:
+                # winget may prefix the header with progress-spinner output; columns are measured from "Name"
+                header_line = line[header_match.start():]
                 break
         
-        if header_index == -1 or header_index + 1 >= len(lines) or not lines[header_index+1].startswith("---"):
-            self.log_window.append("INFO: Winget search output format not recognized or no data rows found.")
+        if header_line is None or not next(lines, "").startswith("---"):
+            log("INFO: Winget search output format not recognized or no data rows found.")
             return apps
 
         # Find column start indices from the header
-        header_line = lines[header_index]
         try:
-            # More robust way to find columns based on typical winget output
-            # Name | ID | Version | Source
-            # Assumes ID, Version, Source are single words after the initial Name block
-            # This is a heuristic and might need adjustment if winget output changes drastically
+            # winget pads every column to a fixed width, so the header offsets
+            # can be used to slice each data row directly.
+            # Name | Id | Version | [Match] | Source
             
             # Find the start of "Id " (with space) to avoid matching "Id" within a name
             id_col_start = header_line.find(" Id ") 
             # Find " Version "
             version_col_start = header_line.find(" Version ", id_col_start)
+            # " Match " is only present when the search term matched a moniker or tag
+            match_col_start = header_line.find(" Match ", version_col_start)
             # Find " Source"
             source_col_start = header_line.find(" Source", version_col_start)
+            version_col_end = match_col_start if match_col_start != -1 else source_col_start
 
             if not all([id_col_start > 0, version_col_start > 0, source_col_start > 0]):
-                 self.log_window.append("INFO: Could not reliably determine column starts from header.")
+                 log("INFO: Could not reliably determine column starts from header.")
                  return apps # Fallback or error
 
-            # Data rows start 2 lines after the header (header, then "----" line)
-            for line in lines[header_index + 2:]:
-                line = line.strip()
+            # Remaining lines are data rows (the header and "----" line have been consumed)
+            data_lines_seen = False
+            for line in lines:
+                data_lines_seen = True
+                line = line.rstrip()
                 if not line or line.startswith("---"): # Skip empty lines or other separators
                     continue
 
                 # Extract based on found column positions
                 name = line[:id_col_start].strip()
-                # For ID, Version, Source, we split the remainder and take the first 3 parts
-                # This handles variable spacing better than fixed slicing for the rightmost columns.
-                remaining_part = line[id_col_start:].strip()
-                parts = re.split(r'\s{2,}', remaining_part) # Split by 2 or more spaces
-                
-                app_id = ""
-                version = ""
-                source = ""
-
-                if len(parts) >= 2: # We need at least ID and Version
-                    app_id = parts[0].strip()
-                    raw_version = parts[1].strip()
-                    
-                    # Clean up the version string: remove any " Tag: ..." suffix
-                    tag_suffix_index = raw_version.find(" Tag: ")
-                    if tag_suffix_index != -1:
-                        version = raw_version[:tag_suffix_index].strip()
-                    else:
-                        version = raw_version
-
-                    if len(parts) >= 4: # Name, Id, Version, Match, Source
-                        # If "Match" column is present, Source is the 4th element from remaining_part split
-                        source = parts[3].strip() 
-                    elif len(parts) == 3: # Name, Id, Version, Source (No "Match" column)
-                        source = parts[2].strip()
-                    else: # Only ID and Version found reliably from parts (and Match might be the 3rd part if it exists without source)
-                        # This case means we have ID and Version, but Source might be missing or part of a 3rd unexpected column.
-                        # If parts has only 2 elements (ID, Version), source will be N/A
-                        source = "N/A" 
-                    
-                    if name and app_id: # Ensure essential fields are present
-                         apps.append({"Name": name, "ID": app_id, "Version": version, "Source": source})
+                app_id = line[id_col_start:version_col_start].strip()
+                raw_version = line[version_col_start:version_col_end].strip()
+                source = line[source_col_start:].strip() or "N/A"
+
+                # Clean up the version string: remove any " Tag: ..." suffix
+                tag_suffix_index = raw_version.find(" Tag:")
+                version = raw_version[:tag_suffix_index].rstrip() if tag_suffix_index != -1 else raw_version
+
+                if name and app_id and version: # Ensure essential fields are present
+                    apps_append(WingetApp(name, app_id, version, source))
                 elif name: # Sometimes only name and ID might appear if the line is malformed or short
-                    # Try a simpler split if the above fails for some lines
-                    parts_simple = line.split()
-                    if len(parts_simple) >=2:
-                        # This fallback is very heuristic and might not be reliable.
-                        # It assumes ID is the last significant word if primary parsing fails.
-                        # Consider removing or refining if it causes incorrect parsing.
-                        app_id_simple = parts_simple[-1] 
-                        name_simple = " ".join(parts_simple[:-1]).strip() # Reconstruct name
+                    # Fall back to treating the last word as the ID and everything before it as the name.
+                    # This fallback is very heuristic and might not be reliable.
+                    # Consider removing or refining if it causes incorrect parsing.
+                    last_space = line.rfind(' ') # line is already right-stripped
+                    if last_space > 0:
+                        app_id_simple = line[last_space + 1:]
+                        name_simple = line[:last_space].strip()
                         # A very basic check to see if app_id_simple looks like an ID
-                        if name_simple and app_id_simple and '.' in app_id_simple: 
-                             apps.append({"Name": name_simple, "ID": app_id_simple, "Version": "N/A", "Source": "N/A"})
+                        if name_simple and '.' in app_id_simple: 
+                             apps_append(WingetApp(name_simple, app_id_simple, "N/A", "N/A"))
 
 
-            if not apps and lines[header_index + 2:]: # If no apps parsed but there were data lines
-                self.log_window.append("INFO: Attempted to parse data rows but no applications were extracted. Check parsing logic against winget output.")
+            if not apps and data_lines_seen: # If no apps parsed but there were data lines
+                log("INFO: Attempted to parse data rows but no applications were extracted. Check parsing logic against winget output.")
 
         except Exception as e:
-            self.log_window.append(f"ERROR: Exception during parsing winget output: {e}")
-            self.log_window.append(traceback.format_exc())
+            log(f"ERROR: Exception during parsing winget output: {e}")
+            if self.log_tracebacks:
+                import traceback
+                log(traceback.format_exc())
         
         return apps
 
-    def handle_search_button_clicked(self):
-        search_term = self.search_input.text().strip()
-        
-        # Clear previous results from table
-        self.table_model.setRowCount(0) # Clears data but keeps headers
-        self.selected_app_label.setText("Selected App: None")
-        self.selected_app_data = None
-
-        if not search_term:
-            self.statusBar().showMessage("Please enter a search term.")
-            self.log_window.append("INFO: Search attempt with empty term.")
-            return
-
-        self.statusBar().showMessage(f"INFO: Attempting to search for: {search_term}...")
-        # Log the command with the added flag
-        self.log_window.append(f"CMD: winget search --accept-source-agreements \"{search_term}\"")
-
+    @Slot()
+    def run(self):
+        import subprocess
+        parsed_apps = []
         try:
-            self.log_window.append("INFO: Preparing to execute winget command...")
+            self._log("INFO: Preparing to execute winget command...")
             
-            command_list = ['winget', 'search', '--accept-source-agreements', search_term]
-
-            process = subprocess.run(
+            command_list = ['winget', 'search', '--accept-source-agreements', self.search_term]
+
+            # Stream the output into the parser as winget produces it rather than buffering it all first.
+            # stderr is merged into stdout (the parser skips everything before the header): with two pipes,
+            # winget could block writing stderr while stdout is still being read.
+            stdout_lines = []
+            def _tee_stdout(pipe):
+                for stdout_line in pipe:
+                    stdout_lines.append(stdout_line)
+                    yield stdout_line
+
+            with subprocess.Popen(
                 command_list,
-                capture_output=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 text=True, 
                 encoding='utf-8',  # Specify UTF-8 encoding
                 errors='replace',   # Replace undecodable characters
-                check=False, 
+                bufsize=1, # Line buffered
                 # shell=False by default
-            )
+            ) as process:
+                self._track_process(process)
+                parsed_apps = self.parse_winget_search_output(_tee_stdout(process.stdout))
+                stdout_lines.extend(process.stdout) # Drain anything the parser did not consume
+                returncode = process.wait()
+            stdout_text = "".join(stdout_lines).strip()
             
-            self.log_window.append(f"INFO: Winget command executed. Return code: {process.returncode}")
-
-            if process.stdout and process.stdout.strip():
-                self.log_window.append("--- stdout ---")
-                self.log_window.append(process.stdout.strip())
-            else:
-                self.log_window.append("INFO: Winget command produced no stdout or stdout was empty.")
+            self._log(f"INFO: Winget command executed. Return code: {returncode}")
 
-            if process.stderr and process.stderr.strip():
-                self.log_window.append("--- stderr ---")
-                self.log_window.append(process.stderr.strip())
+            if stdout_text:
+                self._log("--- output ---")
+                self._log(stdout_text)
             else:
-                self.log_window.append("INFO: Winget command produced no stderr or stderr was empty.")
+                self._log("INFO: Winget command produced no output or output was empty.")
 
-            if process.returncode == 0:
-                if process.stdout and process.stdout.strip():
-                    self.statusBar().showMessage("Search successful. Parsing results...")
-                    self.log_window.append("INFO: Parsing winget output...")
-                    parsed_apps = self.parse_winget_search_output(process.stdout)
-                    
+            if returncode == 0:
+                if stdout_text:
                     if parsed_apps:
-                        self.log_window.append(f"INFO: Parsed {len(parsed_apps)} applications.")
-                        for app_info in parsed_apps:
-                            row = [
-                                QStandardItem(app_info.get("Name", "N/A")),
-                                QStandardItem(app_info.get("ID", "N/A")),
-                                QStandardItem(app_info.get("Version", "N/A")),
-                                QStandardItem(app_info.get("Source", "N/A"))
-                            ]
-                            self.table_model.appendRow(row)
-                        self.search_results_table.resizeColumnsToContents()
-                        self.statusBar().showMessage(f"Search complete. {len(parsed_apps)} applications found.")
+                        self._log(f"INFO: Parsed {len(parsed_apps)} applications.")
+                        self.status.emit(f"Search complete. {len(parsed_apps)} applications found.")
                     else:
-                        self.log_window.append("INFO: No applications were parsed from the output.")
-                        self.statusBar().showMessage("Search complete. No applications found or output not parseable.")
+                        self._log("INFO: No applications were parsed from the output.")
+                        self.status.emit("Search complete. No applications found or output not parseable.")
                 else:
-                    self.statusBar().showMessage("Search successful, but no applications found or no output from winget.")
-                    self.log_window.append("INFO: Search returned success (0), but stdout was empty. Check winget behavior directly in terminal.")
+                    self.status.emit("Search successful, but no applications found or no output from winget.")
+                    self._log("INFO: Search returned success (0), but stdout was empty. Check winget behavior directly in terminal.")
             else:
-                error_message = f"Winget search failed. Return code: {process.returncode}."
-                self.log_window.append(f"ERROR: {error_message}")
-                self.statusBar().showMessage(error_message + " Check log for details.")
+                parsed_apps = [] # Don't show partial results from a failed search
+                error_message = f"Winget search failed. Return code: {returncode}."
+                self._log(f"ERROR: {error_message}")
+                self.status.emit(error_message + " Check log for details.")
 
         except FileNotFoundError:
-            error_message = "ERROR: winget command not found. Please ensure it's installed and in your PATH."
-            self.log_window.append(error_message)
-            self.statusBar().showMessage(error_message)
+            self._report("ERROR", "winget command not found. Please ensure it's installed and in your PATH.")
         except Exception as e:
             error_message = f"ERROR: An unexpected error occurred during search: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(f"Exception type: {type(e)}")
-            self.log_window.append("--- Traceback ---")
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage("An unexpected error occurred. Check log.")
+            self._log(error_message)
+            self._log(f"Exception type: {type(e)}")
+            if self.log_tracebacks:
+                import traceback
+                self._log("--- Traceback ---")
+                self._log(traceback.format_exc())
+            self.status.emit("An unexpected error occurred. Check log.")
+
+        self.log.emit("\n".join(self._log_lines))
+        self._log_lines.clear()
+        self.finished.emit(parsed_apps)
+
+class PackageWorker(_ProcessWorker):
+    """Downloads the installer, generates the scripts and runs IntuneWinAppUtil.exe off the GUI thread."""
+    log = Signal(str)
+    status = Signal(str)
+    progress = Signal(int, str) # 1-based step number (of _PACKAGE_STEP_COUNT), step description
+    finished = Signal(bool, str, str) # success, temp dir of the run, one-line summary of the outcome
+
+    def __init__(self, app, temp_dir, output_package_dir, intunewin_util_path, winget_path, session_dir,
+                 download_cache, stat_cache, log_verbose):
+        super().__init__()
+        self.app = app # WingetApp to package
+        self.temp_dir = temp_dir
+        self.output_package_dir = output_package_dir
+        self.intunewin_util_path = intunewin_util_path
+        self.winget_path = winget_path # Baked into the generated scripts
+        self.session_dir = session_dir # Session temp root; session copies of installers go under downloads/
+        # The session download cache is owned by MainWindow, which leaves it alone while a worker runs
+        self._download_cache = download_cache
+        self._stat_cache = dict(stat_cache) # Seeded with the paths MainWindow validated for this run
+        self._log_verbose = log_verbose
+        self.downloaded_installer_path = None # To store the path to the downloaded installer
+        self.install_script_path = None # To store the path to the generated install.ps1
+        self.uninstall_script_path = None # To store the path to the generated uninstall.ps1
+        self.detection_script_path = None # To store the path to the generated detection.ps1
 
-    def handle_table_selection_changed(self, selected, deselected):
-        selected_indexes = self.search_results_table.selectionModel().selectedRows()
-        if selected_indexes:
-            # Assuming first column is Name (index 0) and second is ID (index 1)
-            # For more robustness, you might want to store full row data or query by header name
-            selected_row = selected_indexes[0].row()
-            name_item = self.table_model.item(selected_row, 0) # Name column
-            id_item = self.table_model.item(selected_row, 1)   # ID column
-            version_item = self.table_model.item(selected_row, 2) # Version
-            source_item = self.table_model.item(selected_row, 3) # Source
+    def _log_traceback(self):
+        """Queues the traceback of the exception being handled; only formatted when verbose or debug logging is on."""
+        if _DEBUG or self._log_verbose:
+            import traceback
+            self._log(traceback.format_exc())
 
-            if name_item and id_item:
-                name = name_item.text()
-                app_id = id_item.text()
-                self.selected_app_label.setText(f"Selected App: {name} ({app_id})")
-                self.selected_app_data = {
-                    "Name": name,
-                    "ID": app_id,
-                    "Version": version_item.text() if version_item else "N/A",
-                    "Source": source_item.text() if source_item else "N/A"
-                }
-                self.statusBar().showMessage(f"Selected: {name}")
-            else:
-                self.selected_app_label.setText("Selected App: Error retrieving details")
-                self.selected_app_data = None
-        else:
-            self.selected_app_label.setText("Selected App: None")
-            self.selected_app_data = None
-            self.statusBar().showMessage("Selection cleared.")
+    def _flush_log(self):
+        if self._log_lines:
+            self.log.emit("\n".join(self._log_lines))
+            self._log_lines.clear()
 
-    def _create_temp_packaging_dir(self):
-        """Creates a unique temporary directory for the packaging process."""
+    @Slot()
+    def run(self):
+        success = False
         try:
-            # Create a unique temporary directory
-            # The directory will be created in the default temporary location for the OS
-            self.current_temp_dir = tempfile.mkdtemp(prefix="winget_pkg_")
-            self.log_window.append(f"INFO: Created temporary directory: {self.current_temp_dir}")
-            # We could also create subdirectories here if a specific structure is needed immediately
-            # For example:
-            # os.makedirs(os.path.join(self.current_temp_dir, "scripts"), exist_ok=True)
-            # os.makedirs(os.path.join(self.current_temp_dir, "installer"), exist_ok=True)
-            return self.current_temp_dir
+            success = self._package()
         except Exception as e:
-            error_message = f"ERROR: Failed to create temporary packaging directory: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage("Error creating temporary directory. Check log.")
-            self.current_temp_dir = None # Ensure it's None on failure
-            return None
+            self._log(f"ERROR: An unexpected error occurred during packaging: {e}")
+            self._log_traceback()
+            self.status.emit("An unexpected error occurred during packaging. Check log.")
+        self._flush_log()
+        app_name = self.app.name
+        if success:
+            summary = f"Successfully packaged {app_name} to {self.output_package_dir}"
+        else:
+            summary = f"Packaging {app_name} failed. Check log for details."
+        self.finished.emit(success, self.temp_dir, summary)
+
+    def _package(self):
+        """Runs the packaging steps for self.app in self.temp_dir. Returns True if the package was created."""
+        from concurrent.futures import ThreadPoolExecutor
+        app_name, app_id, app_version, _ = self.app
+        temp_dir = self.temp_dir
+        output_package_dir = self.output_package_dir
+
+        # 1. Download Installer on a worker thread; the scripts below don't depend on it
+        self.progress.emit(1, "Downloading installer...")
+        with ThreadPoolExecutor(max_workers=4) as executor: # The download plus one worker per script
+            download = self._start_installer_download(app_id, app_version, temp_dir, executor)
+
+            # 2. Generate Scripts while the download runs; the three script writes are independent of each other
+            self.progress.emit(2, "Generating PowerShell scripts...")
+            script_ctx = self._script_context(app_id, app_name, app_version)
+            script_jobs = [
+                (executor.submit(self._generate_install_script, script_ctx, temp_dir), "main install script"),
+                (executor.submit(self._generate_uninstall_script, script_ctx, temp_dir), "uninstall.ps1"),
+                (executor.submit(self._generate_detection_script, script_ctx, temp_dir), "detection.ps1"),
+            ]
+            # Wait for all three before reporting, so no generator is still appending to the log when it is flushed
+            results = [job.result() for job, _ in script_jobs]
+            failed = [script_label for (_, script_label), ok in zip(script_jobs, results) if not ok]
+            scripts_generated = not failed
+            if failed:
+                self._log(f"ERROR: Failed to generate {failed[0]}. Aborting packaging.")
+            else:
+                self._log("INFO: PowerShell script generation completed.")
+            self._flush_log()
+
+            installer_downloaded = self._finish_installer_download(app_id, app_version, temp_dir, download)
+
+        if not installer_downloaded:
+            self._log("ERROR: Failed to download installer. Aborting packaging.")
+            # Status message is set by _start_installer_download/_finish_installer_download
+            return False
+        self._log("INFO: Installer download step completed.")
+        if not scripts_generated:
+            return False
+
+        # 3. Run IntuneWinAppUtil.exe
+        if self._cancelled:
+            self._log("INFO: Packaging cancelled.")
+            return False
+        self.progress.emit(3, "Packaging with IntuneWinAppUtil.exe...")
+        if not self.install_script_path: # Should have been set by _generate_install_script
+            self._log("CRITICAL ERROR: install_script_path not set after script generation. Aborting.")
+            self.status.emit("Critical error: Install script path missing.")
+            return False
+        self._flush_log()
+
+        if not self._run_intunewin_app_util(temp_dir, self.install_script_path, output_package_dir):
+            self._log("ERROR: Failed to package with IntuneWinAppUtil.exe. Check logs.")
+            # Status message set by _run_intunewin_app_util
+            return False
+        return True # run() reports the result
 
     def _find_installer_file(self, download_dir, app_id):
         """Attempts to find the downloaded installer file in the given directory."""
         if not download_dir or not os.path.isdir(download_dir):
-            self.log_window.append(f"ERROR: Download directory '{download_dir}' is invalid or does not exist.")
+            self._log(f"ERROR: Download directory '{download_dir}' is invalid or does not exist.")
             return None
 
-        self.log_window.append(f"INFO: Searching for installer in: {download_dir}")
+        self._log(f"INFO: Searching for installer in: {download_dir}")
         potential_installers = []
-        common_installer_extensions = ('.exe', '.msi', '.msix', '.msixbundle', '.appx', '.appxbundle', '.zip') # Added .zip
 
-        # Scan the primary download directory
-        for item in os.listdir(download_dir):
-            item_path = os.path.join(download_dir, item)
-            if os.path.isfile(item_path) and item.lower().endswith(common_installer_extensions):
-                potential_installers.append(item_path)
+        app_id_lc = app_id.lower()
+        subdirs = []
+
+        # Scan the primary download directory once; DirEntry caches the file/dir type from the listing
+        with os.scandir(download_dir) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    if os.path.splitext(entry.name)[1].lower() in _INSTALLER_EXTS:
+                        potential_installers.append(entry.path)
+                elif entry.is_dir():
+                    subdirs.append(entry)
         
         # Winget sometimes creates a subdirectory named after the App ID or a similar structure.
         # Let's check if such a subdirectory exists and contains the installer.
         # Example: <download_dir>/<app_id_folder>/installer.exe
         # This part is heuristic.
         if not potential_installers:
-            possible_subdir_name_parts = app_id.split('.') # e.g., "Microsoft.Edge" -> ["Microsoft", "Edge"]
+            app_id_parts_lc = app_id_lc.split('.') # e.g., "Microsoft.Edge" -> ["microsoft", "edge"]
+            generic_subdir_names = ('installer', 'install', 'setup', app_id_lc)
             # Check for subdirectories that might match parts of the app_id or common names like 'install', 'setup'
-            for item in os.listdir(download_dir):
-                item_path = os.path.join(download_dir, item)
-                if os.path.isdir(item_path):
-                    # A simple check: if directory name is part of app_id or a generic installer name
-                    if any(part.lower() in item.lower() for part in possible_subdir_name_parts) or \
-                       item.lower() in ['installer', 'install', 'setup', app_id.lower()]:
-                        self.log_window.append(f"INFO: Checking potential sub-directory: {item_path}")
-                        for sub_item in os.listdir(item_path):
-                            sub_item_path = os.path.join(item_path, sub_item)
-                            if os.path.isfile(sub_item_path) and sub_item.lower().endswith(common_installer_extensions):
-                                potential_installers.append(sub_item_path)
-                        if potential_installers: # Found in this subdir, break from checking other subdirs
-                            break 
+            for subdir in subdirs:
+                subdir_name_lc = subdir.name.lower()
+                # A simple check: if directory name is part of app_id or a generic installer name
+                if any(part in subdir_name_lc for part in app_id_parts_lc) or subdir_name_lc in generic_subdir_names:
+                    self._log(f"INFO: Checking potential sub-directory: {subdir.path}")
+                    with os.scandir(subdir.path) as sub_entries:
+                        for sub_entry in sub_entries:
+                            if sub_entry.is_file() and os.path.splitext(sub_entry.name)[1].lower() in _INSTALLER_EXTS:
+                                potential_installers.append(sub_entry.path)
+                    if potential_installers: # Found in this subdir, break from checking other subdirs
+                        break 
 
         if not potential_installers:
-            self.log_window.append(f"ERROR: No installer file found in '{download_dir}' (or relevant subdirectories) with extensions: {common_installer_extensions}")
+            self._log(f"ERROR: No installer file found in '{download_dir}' (or relevant subdirectories) with extensions: {sorted(_INSTALLER_EXTS)}")
             return None
         
         if len(potential_installers) == 1:
             installer_path = potential_installers[0]
-            self.log_window.append(f"INFO: Found installer: {installer_path}")
+            self._log(f"INFO: Found installer: {installer_path}")
             return installer_path
         else:
             # If multiple installers, this is ambiguous. Log and try to pick one.
             # A common scenario is an .exe and a .msi. Heuristics can be complex.
             # For now, let's log a warning and pick the first one found, or one that contains app_id in its name.
-            self.log_window.append(f"WARNING: Multiple potential installers found: {potential_installers}")
+            self._log(f"WARNING: Multiple potential installers found: {potential_installers}")
             # Attempt to find one that contains the app_id in its name (more specific match)
             for p_path in potential_installers:
-                if app_id.lower() in os.path.basename(p_path).lower():
-                    self.log_window.append(f"INFO: Selected installer (contains app_id in name): {p_path}")
+                if app_id_lc in os.path.basename(p_path).lower():
+                    self._log(f"INFO: Selected installer (contains app_id in name): {p_path}")
                     return p_path
-            self.log_window.append(f"INFO: Selecting the first one found as fallback: {potential_installers[0]}")
+            self._log(f"INFO: Selecting the first one found as fallback: {potential_installers[0]}")
             return potential_installers[0] # Fallback, might need refinement
 
     def _sanitize_filename(self, name):
         """Sanitizes a string to be suitable for use as a filename component."""
         if not name: 
             return "DefaultApp"
-        # Remove characters that are invalid in Windows filenames or problematic
-        name = re.sub(r'[\\/:*?\"<>|\s+]', '', name)
-        # Remove any leading/trailing non-alphanumeric characters that might remain after sanitization
-        name = re.sub(r'^[^a-zA-Z0-9]+|\[^a-zA-Z0-9]+$', '', name)
-        if not name: # Fallback if sanitization results in an empty string
-            return "DefaultAppInstall"
-        return name
-
-    def _generate_install_script(self, app_id, app_name, app_version, target_dir):
+        # Keep only characters that are safe in filenames, in a single pass
+        name = "".join(c for c in name if c in _VALID_FN_CHARS)
+        # Remove any leading/trailing punctuation that might remain after sanitization
+        name = name.strip("._-")
+        return name or "DefaultAppInstall" # Fallback if sanitization results in an empty string
+
+    # Script templates by name; each is a module-level constant rendered with str.format_map.
+    _TEMPLATES = {
+        "install": _INSTALL_PS1_TEMPLATE,
+        "uninstall": _UNINSTALL_PS1_TEMPLATE,
+        "detection": _DETECTION_PS1_TEMPLATE,
+    }
+
+    def _script_context(self, app_id, app_name, app_version):
+        """Builds the template context shared by all three scripts, escaping each value for PowerShell once."""
+        return {
+            "app_id": app_id,
+            "app_name": app_name,
+            "app_version": app_version,
+            "app_id_ps": _ps_escape(app_id),
+            "app_name_ps": _ps_escape(app_name),
+            "app_version_ps": _ps_escape(app_version),
+            "winget_path_ps": _ps_escape(self.winget_path),
+        }
+
+    def _render_script(self, name, script_path, ctx):
+        """Renders the named script template with ctx and writes it to script_path. Returns True on success."""
+        script_name = os.path.basename(script_path)
+        # Encode once and write in binary mode: one write, no text-layer encoder or newline translation (scripts keep LF endings)
+        script_bytes = self._TEMPLATES[name].format_map(ctx).encode('utf-8')
+        try:
+            with open(os.open(script_path, _SCRIPT_OPEN_FLAGS, 0o666), 'wb') as f:
+                f.write(script_bytes)
+            self._log(f"INFO: Successfully generated {script_path}")
+            self.status.emit(f"{script_name} generated for {ctx['app_name']}.")
+            return True
+        except Exception as e:
+            error_message = f"ERROR: Failed to write {name} script {script_path}: {e}"
+            self._log(error_message)
+            self._log_traceback()
+            self.status.emit(f"Error generating {script_name}. Check log.")
+            return False
+
+    def _generate_install_script(self, ctx, target_dir):
         """Generates the install.ps1 script (dynamically named) and saves it to the target directory."""
+        app_id, app_name, app_version = ctx.get("app_id"), ctx.get("app_name"), ctx.get("app_version")
         if not all([app_id, app_name, app_version, target_dir]):
-            self.log_window.append("ERROR: Missing data for generating install script (app_id, app_name, app_version, or target_dir).")
+            self._log("ERROR: Missing data for generating install script (app_id, app_name, app_version, or target_dir).")
             self.install_script_path = None # Ensure it's reset
             return None
 
@@ -480,531 +1101,170 @@ class MainWindow(QMainWindow):
         # Update self.install_script_path early so it's available even if generation fails below for some reason
         self.install_script_path = script_path 
 
-        self.log_window.append(f"INFO: Generating {script_name} for {app_name} (ID: {app_id}) in {target_dir}")
-
-        # Using f-string with triple quotes for multiline script content
-        # Ensure PowerShell special characters like $ are escaped by doubling them ($$) if they are meant to be literal in the script
-        # and not part of Python's f-string interpolation. Here, $AppId etc. are PS variables.
-        script_content = f"""# install.ps1 - Generated by Winget2Intunewin GUI Packer
-
-$ErrorActionPreference = 'Stop'
-$ProgressPreference = 'SilentlyContinue'
-
-$AppId = "{app_id}"
-$AppName = "{app_name}" # Used for logging
-$AppVersion = "{app_version}" # Used for specific version install
-
-Write-Host "Starting installation process for $AppName (ID: $AppId, Version: $AppVersion)..."
-
-$WingetPath = ""
-# Attempt to find winget.exe in common locations
-if (Test-Path "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe") {{
-    $WingetPath = Get-Item "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe" | Sort-Object Name -Descending | Select-Object -First 1 -ExpandProperty FullName
-}} elseif (Test-Path "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe") {{
-    $WingetPath = "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe"
-}} else {{
-    Write-Error "Winget executable not found in common paths. Please ensure Winget is installed and accessible."
-    exit 1
-}}
-
-Write-Host "Using Winget executable at: $WingetPath"
-
-try {{
-    Write-Host "Executing: `"$WingetPath`" install --id `"$AppId`" --version `"$AppVersion`" --exact --scope machine --accept-package-agreements --accept-source-agreements --disable-interactivity"
-    # Using Start-Process to better handle execution and capture exit codes if needed, though direct call is also fine.
-    # Add --disable-interactivity for robust silent execution
-    & $WingetPath install --id "$AppId" --version "$AppVersion" --exact --scope machine --accept-package-agreements --accept-source-agreements --disable-interactivity
-    
-    if ($LASTEXITCODE -ne 0) {{
-        Write-Error "Winget install command failed for $AppId with exit code $LASTEXITCODE."
-        exit $LASTEXITCODE
-    }}
-    Write-Host "Winget install command for $AppId (Version: $AppVersion) completed successfully."
-    
-    # Optional: Add further verification steps here if the application creates a specific registry key or file.
-
-}} 
-catch {{
-    Write-Error "An error occurred during the installation of $AppName (ID: $AppId, Version: $AppVersion)."
-    Write-Error $_.Exception.Message
-    # Attempt to get more details if it's a Winget error specifically
-    if ($_.Exception.InnerException) {{
-        Write-Error "Inner Exception: $($_.Exception.InnerException.Message)"
-    }}
-    exit 1 # General error code
-}}
-
-Write-Host "Installation script for $AppName (ID: $AppId, Version: $AppVersion) finished."
-exit 0
-"""
-
-        try:
-            with open(script_path, 'w', encoding='utf-8') as f:
-                f.write(script_content)
-            self.log_window.append(f"INFO: Successfully generated {script_path}")
-            self.statusBar().showMessage(f"{script_name} generated for {app_name}.")
-            # self.install_script_path = script_path # Already set above
-            return script_path
-        except Exception as e:
-            error_message = f"ERROR: Failed to write install script {script_path}: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage(f"Error generating {script_name}. Check log.")
-            # self.install_script_path remains as it might have been set, or None if error before path creation
+        self._log(f"INFO: Generating {script_name} for {app_name} (ID: {app_id}) in {target_dir}")
+        if not self._render_script("install", script_path, ctx):
             return None
+        return script_path
 
-    def _generate_uninstall_script(self, app_id, app_name, target_dir):
+    def _generate_uninstall_script(self, ctx, target_dir):
         """Generates the uninstall.ps1 script and saves it to the target directory."""
+        app_id, app_name = ctx.get("app_id"), ctx.get("app_name")
         if not all([app_id, app_name, target_dir]):
-            self.log_window.append("ERROR: Missing data for generating uninstall script (app_id, app_name, or target_dir).")
+            self._log("ERROR: Missing data for generating uninstall script (app_id, app_name, or target_dir).")
             return None
 
         script_name = "uninstall.ps1"
         script_path = os.path.join(target_dir, script_name)
-        self.log_window.append(f"INFO: Generating {script_name} for {app_name} (ID: {app_id}) in {target_dir}")
-
-        script_content = f"""# uninstall.ps1 - Generated by Winget2Intunewin GUI Packer
-
-$ErrorActionPreference = 'Stop'
-$ProgressPreference = 'SilentlyContinue'
-
-$AppId = "{app_id}"
-$AppName = "{app_name}" # Used for logging
-
-Write-Host "Starting uninstallation process for $AppName (ID: $AppId)..."
-
-$WingetPath = ""
-# Attempt to find winget.exe in common locations
-if (Test-Path "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe") {{
-    $WingetPath = Get-Item "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe" | Sort-Object Name -Descending | Select-Object -First 1 -ExpandProperty FullName
-}} elseif (Test-Path "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe") {{
-    $WingetPath = "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe"
-}} else {{
-    Write-Error "Winget executable not found in common paths. Please ensure Winget is installed and accessible."
-    # For uninstall, if winget is not found, we might not want to fail the whole script if the app isn't there anyway.
-    # However, for an explicit uninstall command, it is an error if winget itself is missing.
-    exit 1 
-}}
-
-Write-Host "Using Winget executable at: $WingetPath"
-
-# Check if the application is installed before attempting to uninstall
-Write-Host "Checking if $AppName (ID: $AppId) is installed..."
-$InstalledApp = & $WingetPath list --id "$AppId" --accept-source-agreements
-
-if ($InstalledApp -match $AppId) {{
-    Write-Host "$AppName (ID: $AppId) is installed. Proceeding with uninstall."
-    try {{
-        Write-Host "Executing: `"$WingetPath`" uninstall --id `"$AppId`" --accept-package-agreements --accept-source-agreements --disable-interactivity"
-        & $WingetPath uninstall --id "$AppId" --accept-package-agreements --accept-source-agreements --disable-interactivity
-        
-        if ($LASTEXITCODE -ne 0) {{
-            Write-Error "Winget uninstall command failed for $AppId with exit code $LASTEXITCODE."
-            exit $LASTEXITCODE
-        }}
-        Write-Host "Winget uninstall command for $AppId completed successfully."
-    }}
-    catch {{
-        Write-Error "An error occurred during the uninstallation of $AppName (ID: $AppId)."
-        Write-Error $_.Exception.Message
-        if ($_.Exception.InnerException) {{
-            Write-Error "Inner Exception: $($_.Exception.InnerException.Message)"
-        }}
-        exit 1 # General error code
-    }}
-}} else {{
-    Write-Host "$AppName (ID: $AppId) is not found or not installed via Winget. Uninstall script will consider this a success (nothing to uninstall)."
-    # In Intune, an uninstall script exiting with 0 when the app is not found is often desired.
-    exit 0 
-}}
-
-Write-Host "Uninstallation script for $AppName (ID: $AppId) finished."
-exit 0
-"""
-
-        try:
-            with open(script_path, 'w', encoding='utf-8') as f:
-                f.write(script_content)
-            self.log_window.append(f"INFO: Successfully generated {script_path}")
-            self.statusBar().showMessage(f"{script_name} generated for {app_name}.")
-            self.uninstall_script_path = script_path
-            return script_path
-        except Exception as e:
-            error_message = f"ERROR: Failed to write uninstall script {script_path}: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage(f"Error generating {script_name}. Check log.")
+        self._log(f"INFO: Generating {script_name} for {app_name} (ID: {app_id}) in {target_dir}")
+        if not self._render_script("uninstall", script_path, ctx):
             self.uninstall_script_path = None
             return None
+        self.uninstall_script_path = script_path
+        return script_path
 
-    def _generate_detection_script(self, app_id, app_name, app_version, target_dir):
+    def _generate_detection_script(self, ctx, target_dir):
         """Generates the detection.ps1 script and saves it to the target directory."""
+        app_id, app_name, app_version = ctx.get("app_id"), ctx.get("app_name"), ctx.get("app_version")
         if not all([app_id, app_name, app_version, target_dir]):
-            self.log_window.append("ERROR: Missing data for generating detection script (app_id, app_name, app_version, or target_dir).")
+            self._log("ERROR: Missing data for generating detection script (app_id, app_name, app_version, or target_dir).")
             return None
 
         script_name = "detection.ps1"
         script_path = os.path.join(target_dir, script_name)
-        self.log_window.append(f"INFO: Generating {script_name} for {app_name} (ID: {app_id}, Version: {app_version}) in {target_dir}")
-
-        # Ensure PowerShell $ variables are escaped as $$ if they are part of the f-string literal template.
-        # Variables like {app_id} are Python f-string interpolations.
-        script_content = f"""# detection.ps1 - Generated by Winget2Intunewin GUI Packer
-
-$ErrorActionPreference = 'Stop'
-$ProgressPreference = 'SilentlyContinue'
-
-$AppId = "{app_id}"
-$AppName = "{app_name}"
-$AppVersion = "{app_version}"
-
-Write-Host "Starting detection for $AppName (ID: $AppId, Version: $AppVersion)..."
-
-$WingetPath = ""
-if (Test-Path "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe") {{
-    $WingetPath = Get-Item "$($env:ProgramFiles)\WindowsApps\Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe\winget.exe" | Sort-Object Name -Descending | Select-Object -First 1 -ExpandProperty FullName
-}} elseif (Test-Path "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe") {{
-    $WingetPath = "$($env:LOCALAPPDATA)\Microsoft\WindowsApps\winget.exe"
-}} else {{
-    Write-Host "Winget executable not found. Cannot perform detection."
-    exit 1
-}}
-
-Write-Host "Using Winget executable at: $WingetPath"
-
-$ExitCode = 1 # Default to not detected
-$TempOutFile = Join-Path $env:TEMP "winget_detect_out_$(Get-Random).txt"
-$TempErrFile = Join-Path $env:TEMP "winget_detect_err_$(Get-Random).txt"
-
-try {{
-    Write-Host "Executing: `"$WingetPath`" list --id `"$AppId`" --version `"$AppVersion`" --exact --accept-source-agreements"
-    $Process = Start-Process -FilePath $WingetPath -ArgumentList "list --id \`"$AppId\`" --version \`"$AppVersion\`" --exact --accept-source-agreements" -NoNewWindow -Wait -PassThru -RedirectStandardOutput $TempOutFile -RedirectStandardError $TempErrFile
-    $CmdExitCode = $Process.ExitCode
-
-    if ($CmdExitCode -eq 0) {{
-        $DetectionOutput = Get-Content $TempOutFile -ErrorAction SilentlyContinue
-        $Found = $false
-        foreach ($line in $DetectionOutput) {{
-            if (($line -match [regex]::Escape($AppId)) -and ($line -match [regex]::Escape($AppVersion))) {{
-                Write-Host "Detected: $AppName (ID: $AppId Version: $AppVersion) - Matched Line: $line"
-                $ExitCode = 0 # Detected
-                $Found = $true
-                break
-            }}
-        }}
-        if (-not $Found) {{
-             Write-Host "Application $AppId with version $AppVersion not found in winget list output (command exit code 0)."
-        }}
-    }} else {{
-        Write-Host "Winget list command failed with exit code $CmdExitCode."
-        $ErrorOutput = Get-Content $TempErrFile -ErrorAction SilentlyContinue
-        if ($ErrorOutput) {{
-            Write-Host "Winget list stderr: $ErrorOutput"
-        }}
-    }}
-}} catch {{
-    Write-Host "An error occurred during the detection process for $AppName (ID: $AppId, Version: $AppVersion). Error: $($_.Exception.Message)"
-    if ($_.Exception.InnerException) {{
-        Write-Host "Inner Exception: $($_.Exception.InnerException.Message)"
-    }}
-    # ExitCode remains 1 (default)
-}} finally {{
-    Remove-Item $TempOutFile -ErrorAction SilentlyContinue
-    Remove-Item $TempErrFile -ErrorAction SilentlyContinue
-}}
-
-if ($ExitCode -eq 0) {{
-    Write-Host "Final Detection Status: Application Found - $AppName (ID: $AppId, Version: $AppVersion). This output is used by Intune."
-}} else {{
-    Write-Host "Final Detection Status: Application Not Found - $AppName (ID: $AppId, Version: $AppVersion)."
-}}
-
-exit $ExitCode
-"""
-
-        try:
-            with open(script_path, 'w', encoding='utf-8') as f:
-                f.write(script_content)
-            self.log_window.append(f"INFO: Successfully generated {script_path}")
-            self.statusBar().showMessage(f"{script_name} generated for {app_name}.")
-            self.detection_script_path = script_path
-            return script_path
-        except Exception as e:
-            error_message = f"ERROR: Failed to write detection script {script_path}: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage(f"Error generating {script_name}. Check log.")
+        self._log(f"INFO: Generating {script_name} for {app_name} (ID: {app_id}, Version: {app_version}) in {target_dir}")
+        if not self._render_script("detection", script_path, ctx):
             self.detection_script_path = None
             return None
+        self.detection_script_path = script_path
+        return script_path
+
+    def _start_installer_download(self, app_id, app_version, download_dir, executor):
+        """Starts downloading the installer for app_id into download_dir on executor and returns the Future.
 
-    def _download_installer(self, app_id, app_version, download_dir):
-        """Downloads the installer for the given app_id to the specified directory."""
+        Returns None when no download was started, either because an installer from earlier in the session was
+        reused or because data is missing; self.downloaded_installer_path is set only in the first case.
+        Pass the result to _finish_installer_download.
+        """
         self.downloaded_installer_path = None # Reset before attempt
         if not app_id or not download_dir:
-            self.log_window.append("ERROR: App ID or download directory missing for download.")
-            self.statusBar().showMessage("Error: Missing information for download.")
-            return False
+            self._log("ERROR: App ID or download directory missing for download.")
+            self.status.emit("Error: Missing information for download.")
+            return None
+
+        # Reuse an installer already downloaded this session for the same ID and version
+        cached_installer = self._download_cache.get((app_id, app_version))
+        if cached_installer and os.path.isfile(cached_installer):
+            installer_path = os.path.join(download_dir, os.path.basename(cached_installer))
+            try:
+                _link_or_copy(cached_installer, installer_path)
+                self.downloaded_installer_path = installer_path
+                self._log(f"INFO: Reusing installer downloaded earlier this session: {cached_installer}")
+                self.status.emit(f"Installer for {app_id} reused from this session.")
+                return None
+            except OSError as e:
+                self._log(f"WARNING: Could not reuse cached installer '{cached_installer}' ({e}). Downloading again.")
 
-        self.log_window.append(f"INFO: Attempting to download installer for ID: {app_id}, Version: {app_version}")
-        self.statusBar().showMessage(f"Downloading {app_id}...")
+        self._log(f"INFO: Attempting to download installer for ID: {app_id}, Version: {app_version}")
+        self.status.emit(f"Downloading {app_id}...")
 
         command = [
-            'winget', 'download',
+            *_WINGET_DL,
             '--id', app_id,
             '--version', app_version, # Specify the exact version
-            '--exact', # Ensure only this version is targeted
             '--download-directory', download_dir,
-            '--accept-package-agreements',
-            '--accept-source-agreements'
-            # Consider adding --scope machine if applicable and supported by download
         ]
 
-        self.log_window.append(f"CMD: {' '.join(command)}")
+        if self._log_verbose:
+            self._log(f"CMD: {_format_command(command)}")
+        return executor.submit(_run_merged_output, command, self._track_process)
 
-        try:
-            process = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                encoding='utf-8',
-                errors='replace',
-                check=False 
-            )
-
-            self.log_window.append(f"INFO: Winget download command executed. Return code: {process.returncode}")
-
-            if process.stdout and process.stdout.strip():
-                self.log_window.append("--- stdout (download) ---")
-                self.log_window.append(process.stdout.strip())
-            else:
-                self.log_window.append("INFO: Winget download produced no stdout or stdout was empty.")
-
-            if process.stderr and process.stderr.strip():
-                self.log_window.append("--- stderr (download) ---")
-                self.log_window.append(process.stderr.strip())
-            else:
-                self.log_window.append("INFO: Winget download produced no stderr or stderr was empty.")
+    def _finish_installer_download(self, app_id, app_version, download_dir, download):
+        """Waits for a download started by _start_installer_download, logs its output and verifies the installer.
 
-            if process.returncode == 0:
-                # Winget download might not produce significant stdout on success, 
-                # but stderr might contain progress or verbose logging.
-                # The main indicator is the return code.
-                self.log_window.append(f"INFO: Winget download command for {app_id} completed.")
-                
-                # Now, try to find the actual downloaded installer file
-                found_installer = self._find_installer_file(download_dir, app_id)
-                if found_installer:
-                    self.downloaded_installer_path = found_installer
-                    self.log_window.append(f"INFO: Successfully verified installer: {self.downloaded_installer_path}")
-                    self.statusBar().showMessage(f"Installer for {app_id} downloaded and verified.")
-                    return True # Download and verification successful
-                else:
-                    self.log_window.append(f"ERROR: Winget download command succeeded for {app_id}, but the installer file could not be found in '{download_dir}'.")
-                    self.statusBar().showMessage(f"Download for {app_id} complete, but installer not found. Check logs.")
-                    return False # Download succeeded, but file not found
-            else:
-                error_message = f"Winget download failed for {app_id}. Return code: {process.returncode}."
-                self.log_window.append(f"ERROR: {error_message}")
-                self.statusBar().showMessage(error_message + " Check log for details.")
-                return False
+        Returns True if an installer is available in download_dir.
+        """
+        if download is None:
+            return self.downloaded_installer_path is not None
+        try:
+            returncode, output_lines = download.result()
+            self._log("--- output (download) ---")
+            for line in output_lines:
+                self._log(line)
 
-        except FileNotFoundError:
-            error_message = "ERROR: winget command not found. Please ensure it's installed and in your PATH."
-            self.log_window.append(error_message)
-            self.statusBar().showMessage(error_message)
-            return False
-        except Exception as e:
-            error_message = f"ERROR: An unexpected error occurred during winget download: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage("An unexpected error occurred during download. Check log.")
-            return False
+            self._log(f"INFO: Winget download command executed. Return code: {returncode}")
 
-    def apply_dark_mode(self):
-        # Modern Dark Theme with Blue/Purple Gradients
-        self.setStyleSheet('''
-            QWidget {
-                background-color: #1e1e2f; /* Dark blue-ish grey */
-                color: #e0e0e0; /* Light grey text */
-                font-size: 10pt;
-                font-family: "Segoe UI", Arial, sans-serif;
-            }
-            QMainWindow {
-                background-color: #1e1e2f;
-            }
-            QGroupBox {
-                background-color: transparent; /* Make GroupBox background transparent */
-                border: 1px solid #4a00e0; /* Purple border */
-                border-radius: 8px;
-                margin-top: 1.5ex; /* Increased top margin for title space */ 
-                font-weight: bold;
-                padding-top: 1.5ex; /* Add padding on top of groupbox content area to push it down */
-            }
-            QGroupBox::title {
-                subcontrol-origin: margin; /* Position relative to the margin */
-                subcontrol-position: top left; 
-                padding: 5px 15px; /* Increased padding for title text */
-                background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #8A2BE2, stop:1 #4A00E0); /* BlueViolet to darker Purple gradient */
-                color: #ffffff;
-                border-radius: 6px; /* Slightly less than GroupBox for a mild inset visual, or match GroupBox's 8px */
-                font-weight: bold;
-                /* Additional offset if needed, negative values pull it up/left */
-                left: 10px; /* Nudge title to the right a bit from the very edge */
-            }
-            QLineEdit, QTextEdit, QTableView {
-                background-color: #252538;
-                color: #e0e0e0;
-                border: 1px solid #8A2BE2; /* Lighter Purple border for inputs */
-                border-radius: 5px;
-                padding: 6px;
-            }
-            QTableView {
-                gridline-color: #4169E1; /* Royal Blue grid lines */
-            }
-            QHeaderView::section { /* For QTableView header */
-                background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #4169E1, stop:1 #3A5FCD); /* RoyalBlue to slightly darker blue */
-                color: #ffffff;
-                padding: 5px;
-                border: 1px solid #3A5FCD;
-                font-weight: bold;
-            }
-            QPushButton {
-                background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #8A2BE2, stop:1 #4169E1); /* BlueViolet to RoyalBlue gradient */
-                color: #ffffff;
-                border: none; /* Remove default border */
-                border-radius: 5px;
-                padding: 8px 15px;
-                font-weight: bold;
-                min-height: 22px;
-            }
-            QPushButton:hover {
-                background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #9B30FF, stop:1 #5179FF); /* Lighter gradient on hover */
-            }
-            QPushButton:pressed {
-                background-color: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #4A00E0, stop:1 #2A4FAD); /* Darker gradient on press */
-            }
-            QLabel {
-                color: #f0f0f0; /* Brighter white for labels */
-                font-weight: bold; /* Make labels bold */
-            }
-            QStatusBar {
-                color: #cccccc;
-            }
-            QStatusBar::item {
-                border: none; /* Remove borders from status bar items */
-            }
-            QScrollBar:horizontal {
-                border: none;
-                background: #252538;
-                height: 10px;
-                margin: 0px 20px 0 20px;
-                border-radius: 5px;
-            }
-            QScrollBar::handle:horizontal {
-                background: qlineargradient(x1:0, y1:0, x2:1, y2:0, stop:0 #8A2BE2, stop:1 #4169E1);
-                min-width: 20px;
-                border-radius: 5px;
-            }
-            QScrollBar::add-line:horizontal, QScrollBar::sub-line:horizontal {
-                border: none;
-                background: none;
-                width: 20px;
-            }
-            QScrollBar::add-page:horizontal, QScrollBar::sub-page:horizontal {
-                background: none;
-            }
-            QScrollBar:vertical {
-                border: none;
-                background: #252538;
-                width: 10px;
-                margin: 20px 0 20px 0;
-                border-radius: 5px;
-            }
-            QScrollBar::handle:vertical {
-                background: qlineargradient(x1:0, y1:0, x2:0, y2:1, stop:0 #8A2BE2, stop:1 #4169E1);
-                min-height: 20px;
-                border-radius: 5px;
-            }
-            QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical {
-                border: none;
-                background: none;
-                height: 20px;
-            }
-            QScrollBar::add-page:vertical, QScrollBar::sub-page:vertical {
-                background: none;
-            }
-            /* Style for the QLineEdit used in the QFileDialog to make it match the theme */
-            QFileDialog QLineEdit {
-                 background-color: #252538;
-                 color: #e0e0e0;
-                 border: 1px solid #8A2BE2;
-                 border-radius: 5px;
-                 padding: 6px;
-            }
-        ''')
-
-    def _browse_for_intunewin_util(self):
-        file_path, _ = QFileDialog.getOpenFileName(
-            self,
-            "Select IntuneWinAppUtil.exe",
-            os.path.dirname(self.intunewin_util_input.text()) if self.intunewin_util_input.text() else os.path.expanduser("~"), # Start in current dir or home
-            "Executable files (*.exe)" # Filter for .exe files
-        )
-        if file_path:
-            # Basic validation: check if filename is IntuneWinAppUtil.exe
-            if os.path.basename(file_path).lower() == "intunewinapputil.exe":
-                self.intunewin_util_path = file_path
-                self.intunewin_util_input.setText(file_path)
-                self._save_settings()
-                self.statusBar().showMessage(f"IntuneWinAppUtil.exe path set to: {file_path}")
-                self.log_window.append(f"INFO: IntuneWinAppUtil.exe path set to: {file_path}")
+            if returncode == 0:
+                # Winget download might not produce significant stdout on success, 
+                # but stderr might contain progress or verbose logging.
+                # The main indicator is the return code.
+                self._log(f"INFO: Winget download command for {app_id} completed.")
+                
+                # Now, try to find the actual downloaded installer file
+                found_installer = self._find_installer_file(download_dir, app_id)
+                if found_installer:
+                    self.downloaded_installer_path = found_installer
+                    self._log(f"INFO: Successfully verified installer: {self.downloaded_installer_path}")
+                    self._cache_downloaded_installer(app_id, app_version, found_installer)
+                    self.status.emit(f"Installer for {app_id} downloaded and verified.")
+                    return True # Download and verification successful
+                else:
+                    self._log(f"ERROR: Winget download command succeeded for {app_id}, but the installer file could not be found in '{download_dir}'.")
+                    self.status.emit(f"Download for {app_id} complete, but installer not found. Check logs.")
+                    return False # Download succeeded, but file not found
             else:
-                self.statusBar().showMessage("Selected file is not IntuneWinAppUtil.exe. Please select the correct file.")
-                self.log_window.append(f"WARNING: User selected '{os.path.basename(file_path)}\' instead of IntuneWinAppUtil.exe")
+                error_message = f"Winget download failed for {app_id}. Return code: {returncode}."
+                self._log(f"ERROR: {error_message}")
+                self.status.emit(error_message + " Check log for details.")
+                return False
 
-    def _load_settings(self):
-        settings = QSettings("WingetGUIOrg", "Winget2IntunewinPacker")
-        loaded_path = settings.value("intunewin_util_path")
-        if loaded_path and isinstance(loaded_path, str) and os.path.isfile(loaded_path): # Check if path exists and is a file
-            self.intunewin_util_path = loaded_path
-            self.intunewin_util_input.setText(self.intunewin_util_path)
-            self.log_window.append(f"INFO: Loaded IntuneWinAppUtil.exe path: {self.intunewin_util_path}")
-        else:
-            self.log_window.append("INFO: IntuneWinAppUtil.exe path not set or invalid. Please configure it.")
+        except FileNotFoundError:
+            self._report("ERROR", "winget command not found. Please ensure it's installed and in your PATH.")
+            return False
+        except Exception as e:
+            error_message = f"ERROR: An unexpected error occurred during winget download: {e}"
+            self._log(error_message)
+            self._log_traceback()
+            self.status.emit("An unexpected error occurred during download. Check log.")
+            return False
 
-    def _save_settings(self):
-        settings = QSettings("WingetGUIOrg", "Winget2IntunewinPacker")
-        if self.intunewin_util_path:
-            settings.setValue("intunewin_util_path", self.intunewin_util_path)
-            self.log_window.append(f"INFO: Saved IntuneWinAppUtil.exe path: {self.intunewin_util_path}")
-        else:
-             settings.remove("intunewin_util_path") # Or settings.setValue("intunewin_util_path", None)
-             self.log_window.append("INFO: Cleared IntuneWinAppUtil.exe path from settings.")
+    def _cache_downloaded_installer(self, app_id, app_version, installer_path):
+        """Keeps a session copy of a downloaded installer so repeat packaging of the same version skips winget."""
+        cache_dir = os.path.join(self.session_dir, "downloads", self._sanitize_filename(f"{app_id}_{app_version}"))
+        cached_installer = os.path.join(cache_dir, os.path.basename(installer_path))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            if not os.path.isfile(cached_installer):
+                _link_or_copy(installer_path, cached_installer)
+            self._download_cache[(app_id, app_version)] = cached_installer
+        except OSError as e:
+            self._log(f"WARNING: Could not keep a session copy of '{installer_path}' ({e}). It will be downloaded again next time.")
 
     def _run_intunewin_app_util(self, source_folder, setup_file_path, output_package_dir):
         """Executes IntuneWinAppUtil.exe to package the application."""
-        if not self.intunewin_util_path or not os.path.isfile(self.intunewin_util_path):
-            self.log_window.append("ERROR: Path to IntuneWinAppUtil.exe is not set or invalid. Please configure it.")
-            self.statusBar().showMessage("Error: IntuneWinAppUtil.exe path not configured.")
+        import subprocess
+        if not _locate_intunewin_util(self.intunewin_util_path):
+            self._log("ERROR: Path to IntuneWinAppUtil.exe is not set or invalid. Please configure it.")
+            self.status.emit("Error: IntuneWinAppUtil.exe path not configured.")
             return False
 
         if not all([source_folder, setup_file_path, output_package_dir]):
-            self.log_window.append("ERROR: Missing source folder, setup file, or output directory for IntuneWinAppUtil.exe.")
+            self._log("ERROR: Missing source folder, setup file, or output directory for IntuneWinAppUtil.exe.")
             return False
         
-        if not os.path.isdir(source_folder):
-            self.log_window.append(f"ERROR: Source folder '{source_folder}\' does not exist.")
+        if _stat_kind(source_folder, self._stat_cache) != 'dir':
+            self._log(f"ERROR: Source folder '{source_folder}\' does not exist.")
             return False
-        if not os.path.isfile(setup_file_path):
-            self.log_window.append(f"ERROR: Setup file '{setup_file_path}\' does not exist.")
+        if _stat_kind(setup_file_path, self._stat_cache) != 'file':
+            self._log(f"ERROR: Setup file '{setup_file_path}\' does not exist.")
             return False
-        if not os.path.isdir(output_package_dir):
-            self.log_window.append(f"ERROR: Output package directory '{output_package_dir}\' does not exist. Creating it...")
+        if _stat_kind(output_package_dir, self._stat_cache) != 'dir':
+            self._log(f"ERROR: Output package directory '{output_package_dir}\' does not exist. Creating it...")
             try:
                 os.makedirs(output_package_dir, exist_ok=True)
-                self.log_window.append(f"INFO: Created output directory: {output_package_dir}")
+                self._stat_cache[output_package_dir] = 'dir'
+                self._log(f"INFO: Created output directory: {output_package_dir}")
             except Exception as e:
-                self.log_window.append(f"ERROR: Failed to create output directory '{output_package_dir}': {e}")
+                self._log(f"ERROR: Failed to create output directory '{output_package_dir}': {e}")
                 return False
 
         # Derive the expected output filename for logging/checking later, though the tool creates it.
@@ -1012,182 +1272,662 @@ exit $ExitCode
         expected_output_filename = os.path.splitext(os.path.basename(setup_file_path))[0] + ".intunewin"
         expected_output_filepath = os.path.join(output_package_dir, expected_output_filename)
 
-        self.log_window.append(f"INFO: Preparing to package '{os.path.basename(setup_file_path)}\' using IntuneWinAppUtil.exe.")
-        self.log_window.append(f"   Source Folder: {source_folder}")
-        self.log_window.append(f"   Setup File: {setup_file_path}")
-        self.log_window.append(f"   Output Directory: {output_package_dir}")
-        self.log_window.append(f"   Expected output file: {expected_output_filepath}")
-        self.statusBar().showMessage(f"Packaging with IntuneWinAppUtil.exe...")
+        self._log(f"INFO: Preparing to package '{os.path.basename(setup_file_path)}\' using IntuneWinAppUtil.exe.")
+        self._log(f"   Source Folder: {source_folder}")
+        self._log(f"   Setup File: {setup_file_path}")
+        self._log(f"   Output Directory: {output_package_dir}")
+        self._log(f"   Expected output file: {expected_output_filepath}")
+        self.status.emit(f"Packaging with IntuneWinAppUtil.exe...")
 
         command = [
             self.intunewin_util_path,
             "-c", source_folder,    # Source folder containing all setup files
             "-s", setup_file_path,  # The setup file (e.g., install.ps1)
             "-o", output_package_dir, # Output directory for the .intunewin file
-            "-q"                    # Quiet mode, suppress UI of the tool
+            *_INTUNEWIN_FLAGS,
         ]
 
-        self.log_window.append(f"CMD: {' '.join(command)}")
+        if self._log_verbose:
+            self._log(f"CMD: {_format_command(command)}")
 
         try:
-            process = subprocess.run(
+            # IntuneWinAppUtil.exe logs to its own log file, but its console output might have summary/errors
+            with subprocess.Popen(
                 command,
-                capture_output=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
                 text=True,
                 encoding='utf-8',
                 errors='replace',
-                check=False,
+                bufsize=1
                 # shell=False is default and recommended
-            )
-
-            self.log_window.append(f"INFO: IntuneWinAppUtil.exe executed. Return code: {process.returncode}")
-
-            # IntuneWinAppUtil.exe logs to its own log file, but stdout/stderr might have summary/errors
-            if process.stdout and process.stdout.strip():
-                self.log_window.append("--- stdout (IntuneWinAppUtil.exe) ---")
-                self.log_window.append(process.stdout.strip())
-            # else:
-                # self.log_window.append("INFO: IntuneWinAppUtil.exe produced no stdout or stdout was empty.")
-
-            if process.stderr and process.stderr.strip():
-                self.log_window.append("--- stderr (IntuneWinAppUtil.exe) ---")
-                self.log_window.append(process.stderr.strip())
-            # else:
-                # self.log_window.append("INFO: IntuneWinAppUtil.exe produced no stderr or stderr was empty.")
+            ) as process:
+                self._track_process(process)
+                self._log("--- output (IntuneWinAppUtil.exe) ---")
+                for line in process.stdout:
+                    line = line.rstrip()
+                    if line:
+                        self._log(line)
+                        # Hand each line to the window as it arrives; MainWindow coalesces them into one update per tick
+                        self._flush_log()
+                process.wait()
+
+            self._log(f"INFO: IntuneWinAppUtil.exe executed. Return code: {process.returncode}")
 
             if process.returncode == 0:
-                self.log_window.append(f"INFO: IntuneWinAppUtil.exe completed successfully.")
+                self._log(f"INFO: IntuneWinAppUtil.exe completed successfully.")
                 # Verify the output file was created
                 if os.path.isfile(expected_output_filepath):
-                    self.log_window.append(f"SUCCESS: Package '{expected_output_filepath}\' created successfully.")
-                    self.statusBar().showMessage(f"Package '{expected_output_filename}\' created successfully!")
+                    self._log(f"SUCCESS: Package '{expected_output_filepath}\' created successfully.")
+                    self.status.emit(f"Package '{expected_output_filename}\' created successfully!")
                     return True
                 else:
-                    self.log_window.append(f"ERROR: IntuneWinAppUtil.exe reported success, but output file '{expected_output_filepath}\' was not found.")
-                    self.statusBar().showMessage("Packaging succeeded, but output file missing. Check logs.")
+                    self._log(f"ERROR: IntuneWinAppUtil.exe reported success, but output file '{expected_output_filepath}\' was not found.")
+                    self.status.emit("Packaging succeeded, but output file missing. Check logs.")
                     return False # Success from tool, but file not found
             else:
                 error_message = f"IntuneWinAppUtil.exe failed. Return code: {process.returncode}. Check its log file for details (usually in %TEMP%\\MicrosoftIntuneAppUtil.log or similar)."
-                self.log_window.append(f"ERROR: {error_message}")
-                self.log_window.append(f"   Attempted command: {' '.join(command)}") # Log the command again on error for easy copy-paste
-                self.statusBar().showMessage(error_message + " Check log for details.")
+                self._log(f"ERROR: {error_message}")
+                self._log(f"   Attempted command: {_format_command(command)}") # Log the command again on error for easy copy-paste
+                self.status.emit(error_message + " Check log for details.")
                 return False
 
         except FileNotFoundError:
-            error_message = f"ERROR: IntuneWinAppUtil.exe not found at '{self.intunewin_util_path}\'. Please check the path."
-            self.log_window.append(error_message)
-            self.statusBar().showMessage(error_message)
+            _intunewin_util_found.discard(self.intunewin_util_path) # Probe the path again on the next run
+            self._report("ERROR", f"IntuneWinAppUtil.exe not found at '{self.intunewin_util_path}\'. Please check the path.")
             return False
         except Exception as e:
             error_message = f"ERROR: An unexpected error occurred while running IntuneWinAppUtil.exe: {e}"
-            self.log_window.append(error_message)
-            self.log_window.append(traceback.format_exc())
-            self.statusBar().showMessage("An unexpected error occurred during packaging. Check log.")
+            self._log(error_message)
+            self._log_traceback()
+            self.status.emit("An unexpected error occurred during packaging. Check log.")
             return False
 
+class MainWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+
+        self.setWindowTitle("Winget2Intunewin GUI Packer")
+        self.setGeometry(100, 100, 900, 700) # Adjusted size for better layout
+
+        # Set Application Window Icon
+        try:
+            icon_path = resource_path("assets/logo.png")
+            if os.path.exists(icon_path):
+                self.setWindowIcon(QIcon(icon_path))
+            else:
+                # This print might not be visible in a bundled app without console
+                print(f"Warning: Window Icon file not found at {icon_path}. Using default icon.")
+        except Exception as e:
+            print(f"Error setting window icon: {e}")
+
+        self.selected_app_data = None # WingetApp for the selected table row
+        self.current_temp_dir = None # To store the path of the current temporary directory
+        self._temp_root = None # tempfile.TemporaryDirectory parenting all packaging temp dirs; removed on close or exit
+        self._session_lock = None # Open, locked _SESSION_LOCK_NAME file in _temp_root while this session uses it
+        self._pkg_counter = 0 # Numbers the per-package subdirectories of _temp_root
+        self._download_cache = {} # (app_id, app_version) -> installer kept under _temp_root/downloads
+        self._winget_path = None # Machine-wide winget.exe on this host, baked into generated scripts; resolved on first use
+        self._cleanup_jobs = {} # temp dir path -> (QThread, TempDirCleanupWorker) for deletions in progress
+        self._stat_cache = {} # path -> 'file'/'dir'/None for input paths validated during the current packaging run
+        self.intunewin_util_path = None # To store path to IntuneWinAppUtil.exe
+        self._package_thread = None # QThread running the current PackageWorker, if any
+        self._reaper_job = None # (QThread, StaleTempRootReaper) while the stale temp root scan runs
+        self._package_worker = None
+        self._search_thread = None # QThread running the current winget search, if any
+        self._search_worker = None
+        self._search_cache = OrderedDict() # Normalized search term -> parsed apps, oldest first
+        self._pending_search_key = None # Cache key of the search currently running
+        self._log_buffer = [] # Pending log lines, written to log_window in one append by _flush_log
+        self._log_verbose = False # Log executed command lines; restored from settings by _load_settings
+        self._settings = QSettings("WingetGUIOrg", "Winget2IntunewinPacker") # Opened once for the window's lifetime
+
+        # Main widget and layout
+        central_widget = QWidget()
+        self.setCentralWidget(central_widget)
+        main_layout = QVBoxLayout(central_widget)
+
+        # --- Search & Selection Area ---
+        search_group = QGroupBox("Search & Selection")
+        search_layout = QVBoxLayout()
+
+        # Application Search Input
+        search_input_layout = QHBoxLayout()
+        search_input_layout.addWidget(QLabel("Search for Application:"))
+        self.search_input = QLineEdit()
+        search_input_layout.addWidget(self.search_input)
+        self.search_button = QPushButton("Search")
+        self.search_button.setToolTip("Shift+click to ignore cached results and search winget again")
+        search_input_layout.addWidget(self.search_button)
+        search_layout.addLayout(search_input_layout)
+
+        # Filter for the current results; narrows the table in memory without re-running winget
+        filter_input_layout = QHBoxLayout()
+        filter_input_layout.addWidget(QLabel("Filter results:"))
+        self.filter_input = QLineEdit()
+        self.filter_input.setPlaceholderText("Type to filter the results below")
+        filter_input_layout.addWidget(self.filter_input)
+        search_layout.addLayout(filter_input_layout)
+
+        # Search Results Display
+        self.search_results_table = QTableView()
+        self.table_model = QStandardItemModel()
+        self.table_model.setHorizontalHeaderLabels(["Name", "ID", "Version", "Source"])
+        self._proxy = QSortFilterProxyModel(self)
+        self._proxy.setSourceModel(self.table_model)
+        self._proxy.setFilterCaseSensitivity(Qt.CaseSensitivity.CaseInsensitive)
+        self._proxy.setFilterKeyColumn(-1) # Match against all columns
+        self.search_results_table.setModel(self._proxy)
+        self.search_results_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.search_results_table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.search_results_table.setEditTriggers(QAbstractItemView.EditTriggers.NoEditTriggers)
+        self.search_results_table.horizontalHeader().setStretchLastSection(True)
+        # self.search_results_table.resizeColumnsToContents() # Call after populating
+        search_layout.addWidget(self.search_results_table)
+        search_group.setLayout(search_layout)
+        main_layout.addWidget(search_group)
+        
+        # --- Packaging Configuration Area ---
+        packaging_group = QGroupBox("Packaging Configuration")
+        packaging_layout = QVBoxLayout()
+
+        # Selected Application Display (simplified for now)
+        self.selected_app_label = QLabel("Selected App: None")
+        packaging_layout.addWidget(self.selected_app_label)
+
+        # Output Folder Selection
+        output_folder_layout = QHBoxLayout()
+        output_folder_layout.addWidget(QLabel("Output Folder for .intunewin:"))
+        self.output_folder_input = QLineEdit()
+        self.output_folder_input.setReadOnly(True) # User selects via browse
+        output_folder_layout.addWidget(self.output_folder_input)
+        self.browse_button = QPushButton("Browse...")
+        output_folder_layout.addWidget(self.browse_button)
+        packaging_layout.addLayout(output_folder_layout)
+
+        # IntuneWinAppUtil.exe Path Selection
+        intunewin_util_layout = QHBoxLayout()
+        intunewin_util_layout.addWidget(QLabel("Path to IntuneWinAppUtil.exe:"))
+        self.intunewin_util_input = QLineEdit()
+        self.intunewin_util_input.setReadOnly(True)
+        intunewin_util_layout.addWidget(self.intunewin_util_input)
+        self.browse_intunewin_util_button = QPushButton("Browse...")
+        intunewin_util_layout.addWidget(self.browse_intunewin_util_button)
+        packaging_layout.addLayout(intunewin_util_layout)
+
+        packaging_group.setLayout(packaging_layout)
+        main_layout.addWidget(packaging_group)
+
+        # --- Action & Status Area ---
+        action_status_group = QGroupBox("Action & Status")
+        action_status_layout = QVBoxLayout()
+
+        # Package Button
+        self.package_button = QPushButton("Create .intunewin Package")
+        action_status_layout.addWidget(self.package_button, alignment=Qt.AlignmentFlag.AlignCenter) # Center the button
+        # Packaging progress; shows the current step instead of logging a line per step
+        self.package_progress = QProgressBar()
+        self.package_progress.setRange(0, _PACKAGE_STEP_COUNT)
+        self.package_progress.setValue(0)
+        self.package_progress.setFormat("Ready")
+        action_status_layout.addWidget(self.package_progress)
+
+        # Log Window (Optional detailed log)
+        self.log_window = QTextEdit()
+        self.log_window.setReadOnly(True)
+        action_status_layout.addWidget(self.log_window)
+        self.verbose_log_checkbox = QCheckBox("Verbose log (show executed commands and error tracebacks)")
+        action_status_layout.addWidget(self.verbose_log_checkbox)
+        action_status_group.setLayout(action_status_layout)
+        main_layout.addWidget(action_status_group)
+        
+        # Status Bar
+        self.setStatusBar(QStatusBar(self))
+        self.statusBar().showMessage("Ready")
+
+        # Connect signals to slots
+        self.browse_button.clicked.connect(self.open_output_folder_dialog)
+        self.search_button.clicked.connect(self.handle_search_button_clicked)
+        # Coalesce keystrokes so a search only runs once typing pauses
+        self._search_debounce = QTimer(self)
+        self._search_debounce.setSingleShot(True)
+        self._search_debounce.setInterval(_SEARCH_DEBOUNCE_MS)
+        self._search_debounce.timeout.connect(self._handle_search_debounce_timeout)
+        self.search_input.textChanged.connect(lambda _: self._search_debounce.start())
+        self.filter_input.textChanged.connect(self._proxy.setFilterFixedString)
+        self.search_results_table.selectionModel().selectionChanged.connect(self.handle_table_selection_changed)
+        self.browse_intunewin_util_button.clicked.connect(self._browse_for_intunewin_util) # Connect new button
+        self.package_button.clicked.connect(self.handle_package_button_clicked) # Connect package button
+        # Log lines are queued and written in one log window update per tick instead of one per line
+        self._log_flush_timer = QTimer(self)
+        self._log_flush_timer.setSingleShot(True)
+        self._log_flush_timer.setInterval(_LOG_FLUSH_MS)
+        self._log_flush_timer.timeout.connect(self._flush_log)
+
+        self._load_settings() # Load settings on startup
+        self.verbose_log_checkbox.toggled.connect(self._set_log_verbose) # After loading, so restoring it doesn't re-save
+        QTimer.singleShot(_STALE_TEMP_REAP_DELAY_MS, self._reap_stale_temp_roots)
+
+        # TODO: Connect other signals to slots (e.g., package_button)
+        # TODO: Implement dark mode theme (initial version applied, can be refined)
+
+    def _log(self, message):
+        """Queues a line for the log window; queued lines are written by _flush_log within _LOG_FLUSH_MS."""
+        self._log_buffer.append(message)
+        if not self._log_flush_timer.isActive():
+            self._log_flush_timer.start()
+
+    def _log_traceback(self):
+        """Queues the traceback of the exception being handled; only formatted when verbose or debug logging is on."""
+        if _DEBUG or self._log_verbose:
+            import traceback
+            self._log(traceback.format_exc())
+
+    def _flush_log(self):
+        """Writes all queued log lines to the log window as a single document update."""
+        if not self._log_buffer:
+            return
+        self.log_window.setUpdatesEnabled(False)
+        self.log_window.append("\n".join(self._log_buffer))
+        self._log_buffer.clear()
+        self.log_window.setUpdatesEnabled(True)
+
+    def open_output_folder_dialog(self):
+        folder_path = QFileDialog.getExistingDirectory(
+            self,
+            "Select Output Folder",
+            self.output_folder_input.text() # Start at current path if any
+        )
+        if folder_path:
+            self.output_folder_input.setText(folder_path)
+            self.statusBar().showMessage(f"Output folder set to: {folder_path}")
+
+    def handle_search_button_clicked(self):
+        self._search_debounce.stop() # An explicit search supersedes any pending typed one
+        force_refresh = bool(QApplication.keyboardModifiers() & Qt.KeyboardModifier.ShiftModifier)
+        self._run_search(force_refresh)
+
+    def _handle_search_debounce_timeout(self):
+        """Searches for the typed term once the user has stopped typing."""
+        if self._search_thread is not None: # A search is still running; retry after another interval
+            self._search_debounce.start()
+            return
+        if self.search_input.text().strip():
+            self._run_search()
+
+    def _run_search(self, force_refresh=False):
+        """Starts a winget search for the current input, or shows cached results for it."""
+        search_term = self.search_input.text().strip()
+        
+        # Clear previous results and any filter applied to them
+        self.table_model.setRowCount(0) # Clears data but keeps headers
+        self.filter_input.clear()
+        self.selected_app_label.setText("Selected App: None")
+        self.selected_app_data = None
+
+        if not search_term:
+            self.statusBar().showMessage("Please enter a search term.")
+            self._log("INFO: Search attempt with empty term.")
+            return
+
+        # Serve repeated searches from the cache; Shift+click forces a fresh winget search
+        cache_key = search_term.lower()
+        if not force_refresh and cache_key in self._search_cache:
+            cached_apps = self._search_cache[cache_key]
+            self._search_cache.move_to_end(cache_key)
+            self._log(f"INFO: Using cached results for '{search_term}' (Shift+click Search to refresh).")
+            self._populate_table(cached_apps)
+            self.statusBar().showMessage(f"Search complete. {len(cached_apps)} applications found (cached).")
+            return
+
+        self.statusBar().showMessage(f"INFO: Attempting to search for: {search_term}...")
+        # Log the command with the added flag
+        if self._log_verbose:
+            self._log(f"CMD: winget search --accept-source-agreements \"{search_term}\"")
+
+        # Run winget on a worker thread so the UI stays responsive while it searches
+        self._pending_search_key = cache_key
+        self.search_button.setEnabled(False)
+        self._search_thread = QThread(self)
+        self._search_worker = WingetSearchWorker(search_term, self._log_verbose)
+        self._search_worker.moveToThread(self._search_thread)
+        self._search_thread.started.connect(self._search_worker.run)
+        self._search_worker.log.connect(self._log)
+        self._search_worker.status.connect(self.statusBar().showMessage)
+        self._search_worker.finished.connect(self._handle_search_finished)
+        self._search_worker.finished.connect(self._search_thread.quit)
+        self._search_worker.finished.connect(self._search_worker.deleteLater)
+        self._search_thread.finished.connect(self._search_thread.deleteLater)
+        self._search_thread.start()
+
+    def _handle_search_finished(self, parsed_apps):
+        """Receives parsed search results from the worker thread and shows them in the table."""
+        self._search_thread = None
+        self._search_worker = None
+        if parsed_apps:
+            self._search_cache[self._pending_search_key] = parsed_apps
+            self._search_cache.move_to_end(self._pending_search_key)
+            if len(self._search_cache) > _SEARCH_CACHE_SIZE:
+                self._search_cache.popitem(last=False) # Evict the least recently used term
+            self._populate_table(parsed_apps)
+        self._pending_search_key = None
+        self.search_button.setEnabled(True)
+
+    def _populate_table(self, apps):
+        """Fills the results table with parsed apps using a single model/view refresh."""
+        rows = [
+            [QStandardItem(name), QStandardItem(app_id), QStandardItem(version), QStandardItem(source)]
+            for name, app_id, version, source in apps
+        ]
+        # Suppress per-row model signals and repaints; the view is refreshed once below
+        self.search_results_table.setUpdatesEnabled(False)
+        self.table_model.blockSignals(True)
+        try:
+            for row in rows:
+                self.table_model.appendRow(row)
+        finally:
+            self.table_model.blockSignals(False)
+            self.table_model.layoutChanged.emit()
+            self.search_results_table.setUpdatesEnabled(True)
+        self.search_results_table.resizeColumnsToContents()
+
+    def handle_table_selection_changed(self, selected, deselected):
+        selected_indexes = self.search_results_table.selectionModel().selectedRows()
+        if selected_indexes:
+            # Assuming first column is Name (index 0) and second is ID (index 1)
+            # For more robustness, you might want to store full row data or query by header name
+            # The view shows the filter proxy, so map back to the row in the source model
+            selected_row = self._proxy.mapToSource(selected_indexes[0]).row()
+            name_item = self.table_model.item(selected_row, 0) # Name column
+            id_item = self.table_model.item(selected_row, 1)   # ID column
+            version_item = self.table_model.item(selected_row, 2) # Version
+            source_item = self.table_model.item(selected_row, 3) # Source
+
+            if name_item and id_item:
+                name = name_item.text()
+                app_id = id_item.text()
+                self.selected_app_label.setText(f"Selected App: {name} ({app_id})")
+                self.selected_app_data = WingetApp(
+                    name,
+                    app_id,
+                    version_item.text() if version_item else "N/A",
+                    source_item.text() if source_item else "N/A"
+                )
+                self.statusBar().showMessage(f"Selected: {name}")
+            else:
+                self.selected_app_label.setText("Selected App: Error retrieving details")
+                self.selected_app_data = None
+        else:
+            self.selected_app_label.setText("Selected App: None")
+            self.selected_app_data = None
+            self.statusBar().showMessage("Selection cleared.")
+
+    def _create_temp_packaging_dir(self):
+        """Creates a unique temporary directory for the packaging process under the session temp root.
+
+        Deletion of the directory kept from a previous failed run, if any, is started on a worker thread first.
+        """
+        import tempfile
+        if self.current_temp_dir:
+            # Only the latest failed run is kept for debugging; reclaim the older one now rather than at exit.
+            # A successful run's directory may still be in _cleanup_jobs, being deleted already.
+            if self.current_temp_dir not in self._cleanup_jobs:
+                self._cleanup_temp_directory(self.current_temp_dir)
+            self.current_temp_dir = None
+        try:
+            # All packaging runs in this session share one root directory in the OS temp location,
+            # created on first use; each run gets its own numbered subdirectory inside it.
+            # TemporaryDirectory also removes the root at interpreter exit if closeEvent never runs.
+            if self._temp_root is None:
+                self._temp_root = tempfile.TemporaryDirectory(prefix=_TEMP_ROOT_PREFIX)
+                # Marks the root as in use for StaleTempRootReaper in other instances, however long this one stays open
+                self._session_lock = open(os.path.join(self._temp_root.name, _SESSION_LOCK_NAME), 'wb')
+                _lock_file_nonblocking(self._session_lock)
+                self._log(f"INFO: Created session temporary directory: {self._temp_root.name}")
+            self._pkg_counter += 1
+            pkg_dir = os.path.join(self._temp_root.name, f"pkg_{self._pkg_counter}")
+            os.makedirs(pkg_dir) # Also recreates the root if something removed it
+            self.current_temp_dir = pkg_dir
+            self._log(f"INFO: Created temporary directory: {self.current_temp_dir}")
+            return self.current_temp_dir
+        except Exception as e:
+            error_message = f"ERROR: Failed to create temporary packaging directory: {e}"
+            self._log(error_message)
+            self._log_traceback()
+            self.statusBar().showMessage("Error creating temporary directory. Check log.")
+            self.current_temp_dir = None # Ensure it's None on failure
+            return None
+
+    def _resolve_winget_path(self):
+        """Returns the machine-wide winget.exe path on this host, or '' if there is none. Looked up once per session."""
+        if self._winget_path is None:
+            import glob
+            program_files = os.environ.get("ProgramFiles")
+            matches = glob.glob(os.path.join(
+                glob.escape(program_files), "WindowsApps", "Microsoft.DesktopAppInstaller_*_x64__8wekyb3d8bbwe", "winget.exe"
+            )) if program_files else []
+            # Prefer the newest DesktopAppInstaller, comparing the digit runs in its folder name numerically
+            self._winget_path = max(
+                matches, default="", key=lambda p: [int(t) if t.isdigit() else t for t in _DIGIT_RUN_RE.split(p)]
+            )
+        return self._winget_path
+
+    def apply_dark_mode(self):
+        self.setStyleSheet(_DARK_QSS)
+
+    def _browse_for_intunewin_util(self):
+        file_path, _ = QFileDialog.getOpenFileName(
+            self,
+            "Select IntuneWinAppUtil.exe",
+            os.path.dirname(self.intunewin_util_input.text()) if self.intunewin_util_input.text() else os.path.expanduser("~"), # Start in current dir or home
+            "Executable files (*.exe)" # Filter for .exe files
+        )
+        if file_path:
+            # Basic validation: check if filename is IntuneWinAppUtil.exe
+            if os.path.basename(file_path).lower() == "intunewinapputil.exe":
+                self.intunewin_util_path = file_path
+                _intunewin_util_found.discard(file_path) # Re-check the tool at the newly chosen path
+                self.intunewin_util_input.setText(file_path)
+                self._save_settings()
+                self.statusBar().showMessage(f"IntuneWinAppUtil.exe path set to: {file_path}")
+                self._log(f"INFO: IntuneWinAppUtil.exe path set to: {file_path}")
+            else:
+                self.statusBar().showMessage("Selected file is not IntuneWinAppUtil.exe. Please select the correct file.")
+                self._log(f"WARNING: User selected '{os.path.basename(file_path)}\' instead of IntuneWinAppUtil.exe")
+
+    def _load_settings(self):
+        self._log_verbose = self._settings.value("verbose_log", False, type=bool)
+        self.verbose_log_checkbox.setChecked(self._log_verbose)
+        loaded_path = self._settings.value("intunewin_util_path")
+        if isinstance(loaded_path, str) and _locate_intunewin_util(loaded_path): # Check if path exists and is a file
+            self.intunewin_util_path = loaded_path
+            self.intunewin_util_input.setText(self.intunewin_util_path)
+            self._log(f"INFO: Loaded IntuneWinAppUtil.exe path: {self.intunewin_util_path}")
+        else:
+            self._log("INFO: IntuneWinAppUtil.exe path not set or invalid. Please configure it.")
+
+    def _set_log_verbose(self, checked):
+        self._log_verbose = checked
+        self._settings.setValue("verbose_log", checked)
+
+    def _save_settings(self):
+        # Writes stay in QSettings' in-memory cache; they are flushed to disk once in closeEvent
+        if self.intunewin_util_path:
+            self._settings.setValue("intunewin_util_path", self.intunewin_util_path)
+            self._log(f"INFO: Saved IntuneWinAppUtil.exe path: {self.intunewin_util_path}")
+        else:
+             self._settings.remove("intunewin_util_path") # Or settings.setValue("intunewin_util_path", None)
+             self._log("INFO: Cleared IntuneWinAppUtil.exe path from settings.")
+
     def handle_package_button_clicked(self):
-        """Orchestrates the entire packaging process when the package button is clicked."""
-        self.log_window.append("INFO: 'Create .intunewin Package' button clicked.")
+        """Validates the inputs and starts packaging the selected application on a worker thread."""
+        self._log("INFO: 'Create .intunewin Package' button clicked.")
         self.statusBar().showMessage("Starting packaging process...")
+        self._stat_cache.clear() # Re-check input paths on every run; they may have changed since the last one
 
         # 1. Validation Checks
         if not self.selected_app_data:
-            self.log_window.append("ERROR: No application selected for packaging.")
+            self._log("ERROR: No application selected for packaging.")
             self.statusBar().showMessage("Error: Please select an application first.")
             return
-        app_id = self.selected_app_data.get("ID")
-        app_name = self.selected_app_data.get("Name")
-        app_version = self.selected_app_data.get("Version")
+        app_name, app_id, app_version, _ = self.selected_app_data
         if not all([app_id, app_name, app_version]):
-            self.log_window.append("ERROR: Selected application data is incomplete (missing ID, Name, or Version).")
+            self._log("ERROR: Selected application data is incomplete (missing ID, Name, or Version).")
             self.statusBar().showMessage("Error: Selected application data incomplete.")
             return
 
         output_package_dir = self.output_folder_input.text()
-        if not output_package_dir or not os.path.isdir(output_package_dir): # Also check if it's a valid dir
-            self.log_window.append("ERROR: Output folder for .intunewin package is not set or invalid.")
+        if not output_package_dir or _stat_kind(output_package_dir, self._stat_cache) != 'dir': # Also check if it's a valid dir
+            self._log("ERROR: Output folder for .intunewin package is not set or invalid.")
             self.statusBar().showMessage("Error: Please set a valid output folder for the package.")
             return
 
-        if not self.intunewin_util_path or not os.path.isfile(self.intunewin_util_path):
-            self.log_window.append("ERROR: Path to IntuneWinAppUtil.exe is not set or invalid. Configure it in Packaging Configuration.")
+        if not _locate_intunewin_util(self.intunewin_util_path):
+            self._log("ERROR: Path to IntuneWinAppUtil.exe is not set or invalid. Configure it in Packaging Configuration.")
             self.statusBar().showMessage("Error: IntuneWinAppUtil.exe path not configured.")
             return
         
-        self.log_window.append(f"INFO: Starting packaging for: {app_name} - {app_id} - {app_version}")
+        self._log(f"INFO: Starting packaging for: {app_name} - {app_id} - {app_version}")
 
         # 2. Create Temporary Directory
         temp_dir = self._create_temp_packaging_dir()
         if not temp_dir:
-            self.log_window.append("ERROR: Failed to create temporary directory. Aborting packaging.")
+            self._log("ERROR: Failed to create temporary directory. Aborting packaging.")
             self.statusBar().showMessage("Error: Failed to create temp directory. Check logs.")
             return
 
-        try:
-            # 3. Download Installer
-            self.log_window.append("INFO: Step 1: Downloading installer...")
-            if not self._download_installer(app_id, app_version, temp_dir):
-                self.log_window.append("ERROR: Failed to download installer. Aborting packaging.")
-                # StatusBar message is set by _download_installer
-                return # No cleanup here yet, will be handled by a finally block or dedicated method later
-            self.log_window.append("INFO: Installer download step completed.")
-
-            # 4. Generate Scripts
-            self.log_window.append("INFO: Step 2: Generating PowerShell scripts...")
-            if not self._generate_install_script(app_id, app_name, app_version, temp_dir):
-                self.log_window.append("ERROR: Failed to generate main install script. Aborting packaging.")
-                return
-            if not self._generate_uninstall_script(app_id, app_name, temp_dir):
-                self.log_window.append("ERROR: Failed to generate uninstall.ps1. Aborting packaging.")
-                return
-            if not self._generate_detection_script(app_id, app_name, app_version, temp_dir):
-                self.log_window.append("ERROR: Failed to generate detection.ps1. Aborting packaging.")
-                return
-            self.log_window.append("INFO: PowerShell script generation completed.")
-
-            # 5. Run IntuneWinAppUtil.exe
-            self.log_window.append("INFO: Step 3: Packaging with IntuneWinAppUtil.exe...")
-            if not self.install_script_path: # Should have been set by _generate_install_script
-                self.log_window.append("CRITICAL ERROR: install_script_path not set after script generation. Aborting.")
-                self.statusBar().showMessage("Critical error: Install script path missing.")
-                return
-            
-            packaging_successful = False # Flag to track overall success for cleanup decision
-            if self._run_intunewin_app_util(temp_dir, self.install_script_path, output_package_dir):
-                self.log_window.append(f"SUCCESS: Successfully packaged {app_name} to {output_package_dir}")
-                self.statusBar().showMessage(f"Successfully packaged {app_name}!")
-                packaging_successful = True
-            else:
-                self.log_window.append("ERROR: Failed to package with IntuneWinAppUtil.exe. Check logs.")
-                # StatusBar message set by _run_intunewin_app_util
-                # packaging_successful remains False
-                return # Abort if packaging itself fails
+        # 3. Download, generate scripts and package on a worker thread so the UI stays responsive
+        self.package_button.setEnabled(False)
+        self._package_thread = QThread(self)
+        self._package_worker = PackageWorker(
+            self.selected_app_data, temp_dir, output_package_dir, self.intunewin_util_path,
+            # Scripts try the winget path found here first, so devices matching this host skip the WindowsApps search
+            self._resolve_winget_path(), self._temp_root.name,
+            self._download_cache, self._stat_cache, self._log_verbose,
+        )
+        self._package_worker.moveToThread(self._package_thread)
+        self._package_thread.started.connect(self._package_worker.run)
+        self._package_worker.log.connect(self._log)
+        self._package_worker.status.connect(self.statusBar().showMessage)
+        self._package_worker.progress.connect(self._set_package_progress)
+        self._package_worker.finished.connect(self._handle_package_finished)
+        self._package_worker.finished.connect(self._package_thread.quit)
+        self._package_worker.finished.connect(self._package_worker.deleteLater)
+        self._package_thread.finished.connect(self._package_thread.deleteLater)
+        self.package_progress.setValue(0)
+        self.package_progress.setFormat("Starting...")
+        self._package_thread.start()
+
+    def _set_package_progress(self, step, description):
+        """Shows the step a PackageWorker has started; the bar fills as steps complete."""
+        self.package_progress.setValue(step - 1)
+        self.package_progress.setFormat(f"Step {step}/{_PACKAGE_STEP_COUNT}: {description}")
+
+    def _handle_package_finished(self, packaging_successful, temp_dir, summary):
+        """Receives the result of a PackageWorker, reports it and cleans up or keeps its temp directory."""
+        self._package_thread = None
+        self._package_worker = None
+        temp_dir_present = bool(temp_dir) and os.path.lexists(temp_dir) # No symlink resolution; False if already gone
+        if temp_dir_present and not packaging_successful:
+            summary += f" Temp files kept at: {temp_dir} until the next package run or until the application is closed."
+        self._report_result(packaging_successful, summary)
+        if packaging_successful:
+            self.package_progress.setValue(_PACKAGE_STEP_COUNT)
+            self.package_progress.setFormat("Package created")
+        else:
+            self.package_progress.setFormat("Packaging failed") # Leave the bar at the step that failed
+        if temp_dir_present and packaging_successful: # Only cleanup on full success
+            self._cleanup_temp_directory(temp_dir)
+        self.package_button.setEnabled(True)
 
-        finally:
-            if temp_dir and os.path.isdir(temp_dir):
-                if packaging_successful: # Only cleanup on full success
-                    self._cleanup_temp_directory(temp_dir)
-                else:
-                    self.log_window.append(f"INFO: Packaging failed or was aborted. Temporary directory '{temp_dir}\' will be kept for debugging.")
-                    self.statusBar().showMessage(f"Packaging failed. Temp files kept at: {temp_dir}")
+    def _report_result(self, success, message):
+        """Shows the outcome of a packaging run as one log line and the matching status bar message."""
+        self._log(f"{'SUCCESS' if success else 'ERROR'}: {message}")
+        self.statusBar().showMessage(message)
 
     def _cleanup_temp_directory(self, temp_dir_path):
-        """Recursively deletes the specified temporary directory."""
-        if temp_dir_path and os.path.isdir(temp_dir_path):
-            self.log_window.append(f"INFO: Attempting to cleanup temporary directory: {temp_dir_path}")
-            try:
-                shutil.rmtree(temp_dir_path)
-                self.log_window.append(f"INFO: Successfully cleaned up temporary directory: {temp_dir_path}")
-                # Clear the instance variable if it matches the one being cleaned
-                if self.current_temp_dir == temp_dir_path:
-                    self.current_temp_dir = None 
-            except Exception as e:
-                error_message = f"ERROR: Failed to cleanup temporary directory '{temp_dir_path}': {e}"
-                self.log_window.append(error_message)
-                self.log_window.append(traceback.format_exc())
-                self.statusBar().showMessage(f"Warning: Failed to cleanup temp directory '{os.path.basename(temp_dir_path)}\'.")
+        """Starts recursively deleting the specified temporary directory on a worker thread.
+
+        No existence check is made first: _fast_rmtree treats a directory that is already gone as deleted.
+        """
+        if not temp_dir_path:
+            return
+        # Only ever delete inside the session temp root, so a bad path can never wipe anything else
+        if self._temp_root is None or not _is_within_dir(temp_dir_path, self._temp_root.name):
+            self._log(f"ERROR: Refusing to delete '{temp_dir_path}\': it is outside the session temporary directory.")
+            return
+        self._log(f"INFO: Attempting to cleanup temporary directory: {temp_dir_path}")
+        thread = QThread(self)
+        worker = TempDirCleanupWorker(temp_dir_path, self._log_verbose)
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        worker.log.connect(self._log)
+        worker.finished.connect(self._handle_cleanup_finished)
+        worker.finished.connect(thread.quit)
+        worker.finished.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        self._cleanup_jobs[temp_dir_path] = (thread, worker)
+        thread.start()
+
+    def _handle_cleanup_finished(self, temp_dir_path, success):
+        """Receives the result of a TempDirCleanupWorker."""
+        self._cleanup_jobs.pop(temp_dir_path, None)
+        if success:
+            self._log(f"INFO: Successfully cleaned up temporary directory: {temp_dir_path}")
+            # Clear the instance variable if it matches the one being cleaned
+            if self.current_temp_dir == temp_dir_path:
+                self.current_temp_dir = None
         else:
-            self.log_window.append(f"INFO: Temporary directory '{temp_dir_path}\' not found or already cleaned up.")
+            self.statusBar().showMessage(f"Warning: Failed to cleanup temp directory '{os.path.basename(temp_dir_path)}\'.")
+
+    def _reap_stale_temp_roots(self):
+        """Starts removing temp roots left behind by earlier sessions on a worker thread."""
+        thread = QThread(self)
+        worker = StaleTempRootReaper()
+        worker.moveToThread(thread)
+        thread.started.connect(worker.run)
+        worker.log.connect(self._log)
+        worker.finished.connect(thread.quit)
+        worker.finished.connect(worker.deleteLater)
+        thread.finished.connect(thread.deleteLater)
+        thread.finished.connect(self._handle_reaper_finished)
+        self._reaper_job = (thread, worker)
+        thread.start()
+
+    def _handle_reaper_finished(self):
+        self._reaper_job = None
+
+    def closeEvent(self, event):
+        if self._reaper_job is not None: # Stop the stale temp root scan after the directory it is removing
+            thread, _ = self._reaper_job
+            thread.requestInterruption()
+            thread.quit()
+            thread.wait()
+        # Stop an in-flight winget search so its thread is not destroyed while running
+        if self._search_thread is not None:
+            self._search_worker.cancel() # Terminates winget instead of waiting for a slow search to finish
+            self._search_thread.quit()
+            self._search_thread.wait()
+        if self._package_thread is not None: # Same for a packaging run; its temp dir is removed with the root below
+            # Terminate its winget download / IntuneWinAppUtil.exe rather than waiting minutes for them to finish
+            self._package_worker.cancel()
+            self._package_thread.quit()
+            self._package_thread.wait()
+        for thread, _ in list(self._cleanup_jobs.values()): # Same for temp directory deletions still running
+            thread.quit()
+            thread.wait()
+        self._settings.sync() # Persist any settings changed during the session in one write
+        if self._session_lock is not None:
+            self._session_lock.close() # Releases the lock; Windows can't delete the file while it is open
+            self._session_lock = None
+        if self._temp_root is not None:
+            # One cleanup point for every packaging temp dir created this session, including ones kept after failures
+            try:
+                self._temp_root.cleanup()
+            except OSError:
+                pass # e.g. a file still in use; nothing more to do at exit
+            self._temp_root = None
+        super().closeEvent(event)
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)